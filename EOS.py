@@ -1,70 +1,98 @@
-# calcluates EOS and absorption for forsterite
+# calcluates EOS and absorption for forsterite (and the other materials in the material registry)
 # fully in SI units
+# nothing is loaded at import, each table and interpolator is built the first time it is used
 
 import uuid
-import matplotlib.pyplot as plt
 import numpy as np
-import woma
 
 np.set_printoptions(precision=4)
-from scipy.interpolate import RegularGridInterpolator, interp1d
+from scipy.interpolate import interp1d
 from scipy.optimize import minimize, root
+from scipy.special import lambertw
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from functools import cached_property, wraps
+from types import SimpleNamespace
 
 import sys
 import os
 
 sys.path.append(f'{os.getcwd()}/aneos-forsterite-2019-1.0.0')
 import eostable
+import EOS_cache
+import EOS_memo
+from EOS_interpolation import bilinear_grid, grid_interpolator
 
-print('Loading EOS tables...')
-
-# loads the eos table from file
-NewEOS = eostable.extEOStable()  # FIRST make new empty EOS object
-
-# LOAD EXTENDED 301 SESAME FILE GENERATED BY STSM VERSION OF ANEOS
-NewEOS.loadextsesame('aneos-forsterite-2019-1.0.0/NEW-SESAME-EXT.TXT')
-# LOAD STANDARD 301 SESAME FILE GENERATED BY STSM VERSION OF ANEOS
-NewEOS.loadstdsesame('aneos-forsterite-2019-1.0.0/NEW-SESAME-STD.TXT')
-
-NewEOS.MODELNAME = 'Forsterite-ANEOS-SLVTv1.0G1'  # string set above in user input
-NewEOS.MDQ = np.zeros((NewEOS.NT, NewEOS.ND))  # makes the empty MDQ array
-
-# EOS properties
-NewEOS.MATID = 1.0
-NewEOS.DATE = 190802
-NewEOS.VERSION = 0.1
-NewEOS.FMN, NewEOS.FMW = 70., 140.691
-NewEOS.R0REF, NewEOS.K0REF = 3.22, 1.1E12
-NewEOS.T0REF, NewEOS.P0REF = 298., 1.E6
-
-NewEOS.loadaneos(aneosinfname='aneos-forsterite-2019-1.0.0/ANEOS.INPUT',
-                 aneosoutfname='aneos-forsterite-2019-1.0.0/ANEOS.OUTPUT', silent=True)
-
-# change units to SI
-NewEOS.rho = NewEOS.rho * 1e3
-NewEOS.P, NewEOS.S = NewEOS.P * 1e9, NewEOS.S * 1e6
-NewEOS.U = NewEOS.U * 1e6
-NewEOS.cs = NewEOS.cs * 1e2
-NewEOS.vc.Sl, NewEOS.vc.Sv = NewEOS.vc.Sl * 1e6, NewEOS.vc.Sv * 1e6
-NewEOS.vc.Pl, NewEOS.vc.Pv = NewEOS.vc.Pl * 1e9, NewEOS.vc.Pv * 1e9
-NewEOS.vc.rl = NewEOS.vc.rl * 1e3
-P_critical_point, S_critical_point = NewEOS.cp.P * 1e9, NewEOS.cp.S * 1e6
-
-# interpolators for future calculations
+# interpolation method used for all EOS tables (the grid interpolators are linear)
 method = 'linear'
-u_interp = RegularGridInterpolator((NewEOS.rho, NewEOS.T), NewEOS.U.T, method=method, bounds_error=False, fill_value=None)
-P_interp = RegularGridInterpolator((NewEOS.rho, NewEOS.T), NewEOS.P.T, method=method, bounds_error=False, fill_value=None)
-S_interp = RegularGridInterpolator((NewEOS.rho, NewEOS.T), NewEOS.S.T, method=method, bounds_error=False, fill_value=None)
-cs_interp = RegularGridInterpolator((NewEOS.rho, NewEOS.T), NewEOS.cs.T, method=method, bounds_error=False, fill_value=None)
-
-# blank interpolators to be filled in later
-rho_interp, T_interp = lambda x: np.full_like(x, np.NaN), lambda x: np.full_like(x, np.NaN)
-T2_interp = lambda x: np.full_like(x, np.NaN)
 
 # range for the (S, P) -> (rho, T) interpolator
 S_range, log_P_range = [1000, 20000], [-6, 13]
 
+# range for the (u, rho) -> T interpolator (u is linear up to 1e5 J/kg and logarithmic above)
+u_range, log_u_range, log_rho_range = [0, 1e5], [5.1, 8], [-10, 5]
+
+# range for the (alpha_v, rho) -> T interpolator
+log_alpha_range, log_rho_alpha_range = [-20, 10], [-5, 1]
+
+# resolution of the derived tables and the solvers used to build them
+n_SP_table, n_uRho_table, n_alpha_table = 400, 800, 400
+SP_solver, uRho_solver, alpha_solver = 'newton', 'direct', 'lambertw'
+
+# treats the liquid-vapor dome exactly when interpolating the (S, P) -> (rho, T) tables (see SP_interpolate)
+SP_phase_split = True
+
+# precision of the interpolation tables and their results, np.float32 halves the memory traffic of the interpolation
+# at a relative error of up to ~5e-7 (see EOS_interpolation), the derived tables are always built in double precision
+table_dtype = np.float64
+
+# number of threads used to evaluate the EOS functions on large arrays, and the number of points each thread is given
+# at a time (see chunked)
+n_threads = 1
+chunk_size = 2 ** 16
+
+# variables that can be given to solve, and the stride of the table points in the coarse index of its starting guesses
+solve_variables = ['P', 'S', 'u', 'rho', 'T']
+solve_index_stride = 2
+
+# derivatives of the EOS that are tabulated on the (rho, T) grid alongside the EOS table
+derivative_fields = ['dP_drho', 'dP_dT', 'dS_drho', 'dS_dT', 'cv']
+
+# derived tables that are stored in the table cache
+derived_tables = ['S_P', 'u_rho', 'alpha_v']
+
+# SESAME header properties of the forsterite table
+forsterite_header = {
+    'MODELNAME': 'Forsterite-ANEOS-SLVTv1.0G1',
+    'MATID': 1.0,
+    'DATE': 190802,
+    'VERSION': 0.1,
+    'FMN': 70.,
+    'FMW': 140.691,
+    'R0REF': 3.22,
+    'K0REF': 1.1E12,
+    'T0REF': 298.,
+    'P0REF': 1.E6,
+}
+
+# SESAME header properties of the iron table
+iron_header = {
+    'MODELNAME': 'Iron-ANEOS-SLVTv0.2G1',
+    'MATID': 2.0,
+    'DATE': 191105,
+    'VERSION': 0.2,
+    'FMN': 26.,
+    'FMW': 55.847,
+    'R0REF': 7.85,
+    'K0REF': 1.45E12,
+    'T0REF': 298.,
+    'P0REF': 1.E6,
+}
+
+# material id used for points with no material id (e.g. empty cells)
+default_matid = 400
+
 
 # allows a function defined within another function to be used in a multiprocessing pool
 def globalize(func):
@@ -75,362 +103,1365 @@ def globalize(func):
     return result
 
 
+# applies a vectorised function that returns a tuple of arrays to the rows of some grid arrays
+# the rows are split between a pool of processes if processes is given
+def map_rows(f, *grids, processes=None):
+    if processes is None:
+        return f(*grids)
+
+    chunks = np.array_split(np.arange(grids[0].shape[0]), processes)
+
+    @globalize
+    def task(rows):
+        return f(*(g[rows] for g in grids))
+
+    with Pool(processes) as pool:
+        results = pool.map(task, chunks)
+
+    return tuple(np.concatenate(r) for r in zip(*results))
+
+
 # calculates fractional error between two values
 def frac_error(x1, x2):
     return np.abs(x1 - x2) / x2
 
 
-# finds T for a given rho and other variable from EOS table
-def reverse_EOS_table_rho_X(interpolator, table, rho, X):
+# values at the centre of each cell of a 2D table (the mean of the corners, as given by bilinear interpolation)
+def cell_centres(a):
+    return 0.25 * (a[:-1, :-1] + a[1:, :-1] + a[:-1, 1:] + a[1:, 1:])
 
-    # find the closest rho index
-    rho_error = frac_error(NewEOS.rho, rho)
-    j = rho_error.argmin()
 
-    # find closest T index from table
-    u_error = frac_error(table[:, j], X)
-    i = u_error.argmin()
+# largest value at the corners of each cell of a 2D table
+def cell_max(a):
+    return np.maximum(np.maximum(a[:-1, :-1], a[1:, :-1]), np.maximum(a[:-1, 1:], a[1:, 1:]))
 
-    # get best guesses for the minimize function
-    rho_guess, T_guess = NewEOS.rho[j], NewEOS.T[i]
 
-    # minimize the error from the interpolator to get the result
-    error = lambda T: frac_error(interpolator(rho, T), X)
-    res = minimize(error, T_guess, method='Nelder-Mead')
-    T_res = res.x
+# turns two multidimensional numpy arrays into a form that can be used with the scipy interpolator
+def make_into_pair_array(arr1, arr2):
+    arr1, arr2 = np.nan_to_num(arr1), np.nan_to_num(arr2)
 
-    # calculates the error for checking
-    X_check = interpolator(rho, T_res)
-    check_error = np.abs(frac_error(X_check, X))
+    if type(arr1) is np.ndarray and type(arr2) is np.ndarray:
 
-    return T_res, check_error
+        if arr1.ndim == 0:
+            return np.array([arr1[()], arr2[0]])
+        if arr2.ndim == 0:
+            return np.array([arr1[0], arr2[()]])
 
+        try:
+            assert np.all(arr1.shape == arr2.shape)
+        except AssertionError:
+            print(f'arr1 = {arr1} \n arr1 shape = {arr1.shape}')
+            print(f'arr2 = {arr2} \n arr2 shape = {arr2.shape}')
+            assert np.all(arr1.shape == arr2.shape)
 
-# finds rho and T from two other variables
-def reverse_EOS_table_X_Y(interpolatorX, tableX, interpolatorY, tableY, X, Y):
+        assert arr1.ndim == 1 or arr1.ndim == 2
 
-    # find the closest rho and T indexes
-    table_error = np.sqrt(frac_error(tableX, X) ** 2 + frac_error(tableY, Y) ** 2)
-    k = table_error.argmin()
-    ncol = table_error.shape[1]
-    i, j = int(k / ncol), int(k % ncol)
-    rho_guess, T_guess = NewEOS.rho[j], NewEOS.T[i]
+        arr = np.array([arr1, arr2])
 
-    # function to minimize
-    X_func = lambda z: interpolatorX(z[0], z[1])
-    Y_func = lambda z: interpolatorY(z[0], z[1])
-    error = lambda z: frac_error(X_func(z), X) ** 2 + frac_error(Y_func(z), Y) ** 2
+        if arr1.ndim == 1:
+            return np.transpose(arr, axes=(1, 0))
+        elif arr1.ndim == 2:
+            return np.transpose(arr, axes=(1, 2, 0))
 
-    res = minimize(error, np.array([rho_guess, T_guess]), method='Nelder-Mead')
-    rho_res, T_res = res.x
+    else:
 
-    # calculates the error for checking
-    X_check = interpolatorX(rho_res, T_res)
-    Y_check = interpolatorY(rho_res, T_res)
-    check_error = np.sqrt(frac_error(X_check, X) ** 2 + frac_error(Y_check, Y) ** 2)
+        if type(arr1) is np.ndarray:
+            if arr1.ndim == 1:
+                arr1 = arr1[0]
 
-    return rho_res, T_res, check_error
+        if type(arr2) is np.ndarray:
+            if arr2.ndim == 1:
+                arr2 = arr2[0]
 
+        return np.array([arr1, arr2])
 
-# generates or loads a numpy array for rho and T as functions of S and P to be used in an interpolator
-def generate_table_S_P(load_from_file=False, n=10):
-    global rho_interp, T_interp
 
-    if load_from_file:
-        print('Loading SP EOS table...')
-        rho_table = np.load(f'EOS_tables/rho_SP_table_n_{n}.npy', allow_pickle=True)
-        T_table = np.load(f'EOS_tables/T_SP_table_n_{n}.npy', allow_pickle=True)
+# constants of the vapor absorption
+alpha_v_B0 = 6e17  # m^-1
+alpha_v_B1, alpha_v_B2 = 37, -11.6
+alpha_v_rho_n, alpha_v_T_n = 1900, 4150  # kg/m^3, K
 
-    # produces table points to be calculated
-    S = np.linspace(S_range[0], S_range[1], num=n)  # in J/K/kg
-    logP = np.linspace(log_P_range[0], log_P_range[1], num=n)  # in log10(Pa)
-    x, y = np.meshgrid(S, logP)
 
-    if not load_from_file:
-        rho_table, T_table = np.zeros_like(x), np.zeros_like(x)
-        error_table = np.zeros_like(x)
+# calculates the absorption of the vapor
+def alpha_v(rho, T):
+    B0, B1, B2 = alpha_v_B0, alpha_v_B1, alpha_v_B2
+    r, t = rho / alpha_v_rho_n, T / alpha_v_T_n
 
-        S_woma = lambda rho, T: woma.s_rho_T(rho, T, 400)
-        P_woma = lambda rho, T: woma.P_T_rho(T, rho, 400)
+    result = B0 * (r ** (1 / 3)) * t * np.exp(-B1 / t) * np.exp(-B2 * (r / t))
 
-        @globalize
-        def task(i):
-            print(f'Start {i}')
-            for j in range(x.shape[1]):
-                rho_table[i, j], T_table[i, j], error_table[i, j] = \
-                    reverse_EOS_table_X_Y(S_woma, NewEOS.S, P_woma, NewEOS.P, x[i, j], 10 ** y[i, j])
-            print(f'Done {i}')
-            return rho_table[i, :], T_table[i, :], error_table[i, :], i
+    return np.nan_to_num(result)
 
-        # fills table values
-        print('Generating SP EOS table:')
-        if __name__ == '__main__':
-            pool = Pool(7)
-            results = pool.map(task, range(x.shape[0]))
 
-        for r in results:
-            i = r[3]
-            rho_table[i, :] = r[0]
-            T_table[i, :] = r[1]
-            error_table[i, :] = r[2]
+# calculates T for a given rho and absorption of the vapor by inverting alpha_v exactly
+# alpha_v = A t exp(-c / t) with A = B0 r^(1/3) and c = B1 + B2 r, so c / t = W(c A / alpha_v) (the Lambert W function)
+# alpha_v only increases monotonically with T where c > 0 (rho < ~6000 kg/m^3), NaN is returned elsewhere
+def T_from_alpha_v(rho, alpha):
+    r = rho / alpha_v_rho_n
+    A = alpha_v_B0 * (r ** (1 / 3))
+    c = alpha_v_B1 + alpha_v_B2 * r
 
-        plt.contourf(x, y, np.log10(rho_table), 80, cmap='cubehelix')
-        plt.colorbar()
-        plt.show()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = c / lambertw(c * A / alpha).real
 
-        np.save(f'EOS_tables/rho_SP_table_n_{n}.npy', rho_table)
-        np.save(f'EOS_tables/T_SP_table_n_{n}.npy', T_table)
+    return np.where(c > 0, t * alpha_v_T_n, np.NaN)
 
-        plt.contourf(S, logP, np.log10(error_table), 80)
-        plt.colorbar()
-        plt.show()
 
-    rho_interp = RegularGridInterpolator((S, logP), rho_table.T, method=method, bounds_error=False, fill_value=None)
-    T_interp = RegularGridInterpolator((S, logP), T_table.T, method=method, bounds_error=False, fill_value=None)
+# set in the threads evaluating a chunk, so that the EOS methods they call are not chunked or memoised again
+thread_state = threading.local()
+thread_pools = {}
 
 
-# generates or loads a numpy array for  T as functions of rho and u to be used in an interpolator
-def generate_table_u_rho(load_from_file=False, n=10):
-    global T2_interp
+# pool of n_threads threads, kept for later calls
+def thread_pool():
+    if n_threads not in thread_pools:
+        thread_pools[n_threads] = ThreadPoolExecutor(n_threads)
+    return thread_pools[n_threads]
 
-    if load_from_file:
-        print('Loading u rho EOS table...')
-        T_table = np.load(f'EOS_tables/T_uRho_table_n_{n}.npy', allow_pickle=True)
 
-    # produces table points to be calculated
-    u = np.concatenate((np.linspace(0, 1e5, num=int(n/2)), np.logspace(5.1, 8, num=int(n/2))))
-    log_rho = np.linspace(-10, 5, num=n)
-    x, y = np.meshgrid(u, log_rho)
+# evaluates an element-wise EOS method on a pool of n_threads threads if its array arguments have more than chunk_size
+# points, splitting them into chunks of chunk_size points (numpy releases the GIL for the array operations)
+# the results are identical to evaluating the whole arrays at once
+def chunked(method):
+    @wraps(method)
+    def result(self, *args, **kwargs):
+        if n_threads <= 1 or getattr(thread_state, 'in_chunk', False):
+            return method(self, *args, **kwargs)
 
-    if not load_from_file:
-        T_table = np.zeros_like(x)
-        error_table = np.zeros_like(x)
-
-        @globalize
-        def task(i):
-            print(f'Start {i}')
-            for j in range(x.shape[1]):
-                #T_table[j, i], error_table[j, i] = reverse_EOS_table_rho_X(u_EOS, NewEOS.U, 10 ** y[i, j], x[i, j])
-                T_table[j, i] = woma.T_u_rho(x[i, j], 10 ** y[i, j], 400)
-            print(f'Done {i}')
-            return T_table[:, i], i
-
-        # fills table values
-        print('Generating u rho EOS table:')
+        array_args = [i for i, a in enumerate(args) if np.ndim(a) > 0]
+        shape = np.broadcast_shapes(*[np.shape(args[i]) for i in array_args]) if len(array_args) > 0 else ()
+        size = int(np.prod(shape))
+        if size <= chunk_size:
+            return method(self, *args, **kwargs)
 
-        if __name__ == '__main__':
-            pool = Pool(7)
-            results = pool.map(task, range(x.shape[0]))
+        out = kwargs.pop('out', None)
+        args = [np.broadcast_to(np.asarray(a), shape).reshape(-1) if i in array_args else a for i, a in enumerate(args)]
 
-        for r in results:
-            i = r[1]
-            T_table[:, i] = r[0]
+        def task(start):
+            thread_state.in_chunk = True
+            try:
+                return method(self, *[a[start:start + chunk_size] if i in array_args else a
+                                      for i, a in enumerate(args)], **kwargs)
+            finally:
+                thread_state.in_chunk = False
 
-        np.save(f'EOS_tables/T_uRho_table_n_{n}.npy', T_table)
+        # the first chunk is evaluated here so that any tables are loaded before the other threads need them
+        starts = range(0, size, chunk_size)
+        parts = [task(starts[0])] + list(thread_pool().map(task, starts[1:]))
 
-    T2_interp = RegularGridInterpolator((u, log_rho), T_table, method=method, bounds_error=False, fill_value=None)
+        if isinstance(parts[0], dict):
+            return {k: np.concatenate([p[k] for p in parts]).reshape(shape) for k in parts[0]}
+        if out is not None:
+            out[...] = np.concatenate(parts).reshape(shape)
+            return out
+        return np.concatenate(parts).reshape(shape)
 
+    return result
 
-# turns two multidimensional numpy arrays into a form that can be used with the scipy interpolator
-def make_into_pair_array(arr1, arr2):
-    arr1, arr2 = np.nan_to_num(arr1), np.nan_to_num(arr2)
 
-    if type(arr1) is np.ndarray and type(arr2) is np.ndarray:
+# caches the results of an EOS method in the memo cache of the material, if it has one (see enable_memo)
+# calls writing into an out array are not cached
+def memoised(method):
+    @wraps(method)
+    def result(self, *args, **kwargs):
+        if self.memo is None or kwargs.get('out') is not None or getattr(thread_state, 'in_chunk', False):
+            return method(self, *args, **kwargs)
+        return self.memo(method.__name__, lambda: method(self, *args, **kwargs), args, kwargs)
 
-        if arr1.ndim == 0:
-            return np.array([arr1[()], arr2[0]])
-        if arr2.ndim == 0:
-            return np.array([arr1[0], arr2[()]])
+    return result
 
-        try:
-            assert np.all(arr1.shape == arr2.shape)
-        except AssertionError:
-            print(f'arr1 = {arr1} \n arr1 shape = {arr1.shape}')
-            print(f'arr2 = {arr2} \n arr2 shape = {arr2.shape}')
-            assert np.all(arr1.shape == arr2.shape)
 
-        assert arr1.ndim == 1 or arr1.ndim == 2
+# class containing the EOS of a single material
+# the tables and interpolators are only loaded or generated the first time they are needed
+# source says where the SESAME and ANEOS files in aneos_dir can be downloaded from if they are not in the repository
+class material_EOS:
+
+    def __init__(self, aneos_dir, header, woma_id, table_dir='EOS_tables', dtype=None, source=None):
+
+        self.dtype = np.dtype(table_dtype if dtype is None else dtype)
+        self.aneos_dir = aneos_dir
+        self.source = source
+        self.header = header
+        self.woma_id = woma_id
+        self.table_dir = table_dir
+        self.cache_dir = f'{table_dir}/cache'
+        self.source_files = [f'{aneos_dir}/NEW-SESAME-STD.TXT', f'{aneos_dir}/NEW-SESAME-EXT.TXT',
+                             f'{aneos_dir}/ANEOS.INPUT', f'{aneos_dir}/ANEOS.OUTPUT']
+
+        # coarse indexes of the starting guesses of solve, for each pair of given variables
+        self.solve_indexes = {}
+
+        # cache of the results of repeated calls with the same arrays, None unless enable_memo is called
+        self.memo = None
+
+    # caches the results of up to max_size calls of the EOS functions, so calling them again with the same input
+    # arrays returns the cached result (see EOS_memo), hits and misses are counted in self.memo.stats()
+    def enable_memo(self, max_size=32):
+        self.memo = EOS_memo.memo_cache(max_size)
+
+    def disable_memo(self):
+        self.memo = None
+
+    # sets the precision of the interpolation tables (np.float64 or np.float32), the interpolators are remade when next used
+    def set_dtype(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self.solve_indexes = {}
+        if self.memo is not None:
+            self.memo.clear()
+        for k in ['eos_grid_tables', 'S_P_grid_tables', 'u_rho_grid_tables', 'alpha_v_grid_tables', 'rho_T_grid',
+                  'u_interp', 'P_interp', 'S_interp', 'cs_interp', 'derivative_interps', 'KPA_interp', 'S_logP_grid', 'rho_interp', 'T_interp', 'T2_interp', 'T3_interp']:
+            self.__dict__.pop(k, None)
+
+    # loads the eos table from file
+    @cached_property
+    def NewEOS(self):
+        print('Loading EOS tables...')
+
+        NewEOS = eostable.extEOStable()  # FIRST make new empty EOS object
+
+        # EOS properties
+        for k, v in self.header.items():
+            setattr(NewEOS, k, v)
+
+        # LOAD EXTENDED AND STANDARD 301 SESAME FILES GENERATED BY STSM VERSION OF ANEOS
+        # (from the binary cache if the text files have not changed since it was written)
+        NewEOS.loadall(*self.source_files, cachedir=f'{self.table_dir}/sesame_cache', silent=True)
+
+        NewEOS.MDQ = np.zeros((NewEOS.NT, NewEOS.ND))  # makes the empty MDQ array
+
+        # change units to SI
+        NewEOS.rho = NewEOS.rho * 1e3
+        NewEOS.P, NewEOS.S = NewEOS.P * 1e9, NewEOS.S * 1e6
+        NewEOS.U = NewEOS.U * 1e6
+        NewEOS.cs, NewEOS.cv = NewEOS.cs * 1e2, NewEOS.cv * 1e6
+        NewEOS.vc.Sl, NewEOS.vc.Sv = NewEOS.vc.Sl * 1e6, NewEOS.vc.Sv * 1e6
+        NewEOS.vc.Pl, NewEOS.vc.Pv = NewEOS.vc.Pl * 1e9, NewEOS.vc.Pv * 1e9
+        NewEOS.vc.rl, NewEOS.vc.rv = NewEOS.vc.rl * 1e3, NewEOS.vc.rv * 1e3
+
+        return NewEOS
+
+    # the arrays used by the interpolators, in the layout and precision they use them in, are stored in the table cache
+    # and memory mapped, so every process using the EOS (e.g. the workers of a pool, whether forked or spawned) shares
+    # one read only copy of them through the page cache, and evaluating the EOS does not need the SESAME tables
+    # 'eos_grid' holds the (rho, T) tables, vapor curve and critical point, and 'S_P_grid', 'u_rho_grid' and
+    # 'alpha_v_grid' each hold one of the derived tables, so that only the derived tables that are used are built
+    def grid_tables(self, name, rebuild=False):
+        spec = {'table': name, 'material': self.header['MODELNAME'], 'dtype': self.dtype.name}
+
+        if name == 'eos_grid':
+            spec.update(source=self.source_key, derivatives=derivative_fields)
+            build = self.make_eos_grid_tables
+        elif name in [f'{table}_grid' for table in derived_tables]:
+            table = name[:-len('_grid')]
+            spec['derived'] = EOS_cache.table_key(self.table_spec(table))
+            build = lambda: self.make_derived_grid_tables(table)
+        else:
+            raise ValueError(f'Unknown grid tables {name}')
+
+        return EOS_cache.cached_table(self.cache_dir, spec, build, rebuild=rebuild)
+
+    def make_eos_grid_tables(self):
+        NewEOS, vc = self.NewEOS, self.NewEOS.vc
+        grid = lambda table: np.ascontiguousarray(table.T, dtype=self.dtype)
+
+        tables = {'rho': NewEOS.rho, 'T': NewEOS.T,
+                  'P': grid(NewEOS.P), 'S': grid(NewEOS.S), 'u': grid(NewEOS.U), 'cs': grid(NewEOS.cs),
+                  'cv': grid(NewEOS.cv), 'KPA': grid(NewEOS.KPA),
+                  'critical_point': np.array([NewEOS.cp.P * 1e9, NewEOS.cp.S * 1e6], dtype=float)}
+
+        # derivatives at the table points with respect to ln(rho) and ln(T) (second order differences on the grid),
+        # these vary much less between the logarithmically spaced table points than the derivatives themselves
+        ln_T, ln_rho = np.log(NewEOS.T), np.log(NewEOS.rho)
+        tables['dP_drho'], tables['dP_dT'] = [grid(d) for d in np.gradient(NewEOS.P, ln_T, ln_rho)[::-1]]
+        tables['dS_drho'], tables['dS_dT'] = [grid(d) for d in np.gradient(NewEOS.S, ln_T, ln_rho)[::-1]]
+        for k in ['T', 'rl', 'rv', 'Pl', 'Pv', 'Sl', 'Sv']:
+            tables[f'vc_{k}'] = getattr(vc, k)
+
+        return tables
+
+    def make_derived_grid_tables(self, table):
+        grid = lambda values: np.ascontiguousarray(values, dtype=self.dtype)
+        if table == 'S_P':
+            return {'rho': grid(self.S_P_table['rho'].T), 'T': grid(self.S_P_table['T'].T)}
+        return {'T': grid(getattr(self, f'{table}_table')['T'])}
+
+    @cached_property
+    def eos_grid_tables(self):
+        return self.grid_tables('eos_grid')
+
+    @cached_property
+    def S_P_grid_tables(self):
+        return self.grid_tables('S_P_grid')
+
+    @cached_property
+    def u_rho_grid_tables(self):
+        return self.grid_tables('u_rho_grid')
+
+    @cached_property
+    def alpha_v_grid_tables(self):
+        return self.grid_tables('alpha_v_grid')
+
+    @cached_property
+    def P_critical_point(self):
+        return float(self.eos_grid_tables['critical_point'][0])
+
+    @cached_property
+    def S_critical_point(self):
+        return float(self.eos_grid_tables['critical_point'][1])
+
+    # the vapor curve of the EOS table (in SI units), with the same names as NewEOS.vc
+    @cached_property
+    def vapor_curve(self):
+        tables = self.eos_grid_tables
+        return SimpleNamespace(**{k[3:]: tables[k] for k in tables if k.startswith('vc_')})
+
+    # the (rho, T) grid of the EOS table, shared by all of the interpolators over it
+    @cached_property
+    def rho_T_grid(self):
+        return bilinear_grid(self.eos_grid_tables['rho'], self.eos_grid_tables['T'], dtype=self.dtype)
+
+    # makes an interpolator over the (rho, T) grid of the EOS table
+    def rho_T_interpolator(self, table):
+        tables = self.eos_grid_tables
+        return grid_interpolator(tables['rho'], tables['T'], tables[table], grid=self.rho_T_grid)
+
+    # interpolators for future calculations
+    @cached_property
+    def u_interp(self):
+        return self.rho_T_interpolator('u')
+
+    @cached_property
+    def P_interp(self):
+        return self.rho_T_interpolator('P')
+
+    @cached_property
+    def S_interp(self):
+        return self.rho_T_interpolator('S')
+
+    @cached_property
+    def cs_interp(self):
+        return self.rho_T_interpolator('cs')
+
+    # interpolator of a table of NewEOS in double precision whatever the dtype of the material, used for the error
+    # maps of the derived tables so that they do not depend on the precision of the process that builds them
+    def reference_interpolator(self, table):
+        return grid_interpolator(self.NewEOS.rho, self.NewEOS.T, table.T)
+
+    # interpolators of the derivative tables, by name
+    @cached_property
+    def derivative_interps(self):
+        return {k: self.rho_T_interpolator(k) for k in derivative_fields}
+
+    @cached_property
+    def KPA_interp(self):
+        return self.rho_T_interpolator('KPA')
+
+    # table points of the (S, P) -> (rho, T) interpolator
+    def S_P_grid(self, n):
+        S = np.linspace(S_range[0], S_range[1], num=n)  # in J/K/kg
+        logP = np.linspace(log_P_range[0], log_P_range[1], num=n)  # in log10(Pa)
+        return S, logP
+
+    # table points of the (u, rho) -> T interpolator
+    def u_rho_grid(self, n):
+        u = np.concatenate((np.linspace(u_range[0], u_range[1], num=int(n/2)),
+                            np.logspace(log_u_range[0], log_u_range[1], num=int(n/2))))
+        log_rho = np.linspace(log_rho_range[0], log_rho_range[1], num=n)
+        return u, log_rho
+
+    # table points of the (alpha_v, rho) -> T interpolator
+    def alpha_v_grid(self, n):
+        log_alpha = np.linspace(log_alpha_range[0], log_alpha_range[1], num=n)
+        log_rho = np.linspace(log_rho_alpha_range[0], log_rho_alpha_range[1], num=n)
+        return log_alpha, log_rho
+
+    # raises a FileNotFoundError saying where to get the SESAME and ANEOS files of the material if any are missing
+    def check_source_files(self):
+        missing = [f for f in self.source_files if not os.path.isfile(f)]
+        if len(missing) > 0:
+            where = f' (download them from {self.source})' if self.source is not None else ''
+            raise FileNotFoundError(f"Missing EOS files for {self.header['MODELNAME']}: {', '.join(missing)}{where}")
+
+    # hash of the SESAME and ANEOS files that the derived tables are made from
+    @cached_property
+    def source_key(self):
+        self.check_source_files()
+        return eostable.sesamecachekey(self.source_files)
+
+    # everything a derived table depends on, the table is rebuilt whenever this changes
+    def table_spec(self, table):
+        spec = {'table': table, 'material': self.header['MODELNAME'], 'method': method}
+
+        if table == 'S_P':
+            spec.update(source=self.source_key, n=n_SP_table, S_range=S_range, log_P_range=log_P_range,
+                        solver=SP_solver)
+        elif table == 'u_rho':
+            spec.update(source=self.source_key, n=n_uRho_table, u_range=u_range, log_u_range=log_u_range,
+                        log_rho_range=log_rho_range, solver=uRho_solver)
+        elif table == 'alpha_v':
+            spec.update(n=n_alpha_table, log_alpha_range=log_alpha_range, log_rho_range=log_rho_alpha_range,
+                        solver=alpha_solver)
+        else:
+            raise ValueError(f'Unknown table {table}')
+
+        if spec.get('solver') in ['nelder-mead', 'woma']:
+            spec['woma_id'] = self.woma_id
+
+        return spec
+
+    # loads a derived table from the cache, building it (in a pool of processes if given) if it has not been made
+    # with SP_solver = 'nelder-mead' the legacy (S, P) tables in table_dir are imported rather than rebuilt
+    def derived_table(self, table, rebuild=False, processes=None):
+        if table == 'S_P' and SP_solver == 'nelder-mead' and all(map(os.path.isfile, self.legacy_S_P_files(n_SP_table))):
+            build = lambda: self.load_legacy_S_P_table(n_SP_table)
+        elif table == 'S_P':
+            build = lambda: self.generate_table_S_P(n=n_SP_table, solver=SP_solver, plot=False, processes=processes)
+        elif table == 'u_rho':
+            build = lambda: self.generate_table_u_rho(n=n_uRho_table, solver=uRho_solver, processes=processes)
+        else:
+            build = lambda: self.generate_table_alpha_v(n=n_alpha_table, solver=alpha_solver)
+
+        return EOS_cache.cached_table(self.cache_dir, self.table_spec(table), build, rebuild=rebuild)
+
+    # builds any derived tables that have not been made (or all of them if rebuild is True)
+    def build_tables(self, rebuild=False, processes=None):
+        for table in derived_tables:
+            self.__dict__[f'{table}_table'] = self.derived_table(table, rebuild=rebuild, processes=processes)
+            self.__dict__[f'{table}_grid_tables'] = self.grid_tables(f'{table}_grid', rebuild=rebuild)
+
+        if self.memo is not None:
+            self.memo.clear()
+
+        # interpolators made from the old tables are remade when next used
+        for k in ['S_logP_grid', 'rho_interp', 'T_interp', 'T2_interp', 'T3_interp']:
+            self.__dict__.pop(k, None)
+
+    @cached_property
+    def S_P_table(self):
+        return self.derived_table('S_P')
+
+    @cached_property
+    def u_rho_table(self):
+        return self.derived_table('u_rho')
+
+    @cached_property
+    def alpha_v_table(self):
+        return self.derived_table('alpha_v')
+
+    # the (S, log(P)) grid of the derived tables, shared by the rho and T interpolators
+    @cached_property
+    def S_logP_grid(self):
+        return bilinear_grid(*self.S_P_grid(n_SP_table), dtype=self.dtype)
+
+    @cached_property
+    def rho_interp(self):
+        S, logP = self.S_P_grid(n_SP_table)
+        return grid_interpolator(S, logP, self.S_P_grid_tables['rho'], grid=self.S_logP_grid)
+
+    @cached_property
+    def T_interp(self):
+        S, logP = self.S_P_grid(n_SP_table)
+        return grid_interpolator(S, logP, self.S_P_grid_tables['T'], grid=self.S_logP_grid)
+
+    @cached_property
+    def T2_interp(self):
+        u, log_rho = self.u_rho_grid(n_uRho_table)
+        return grid_interpolator(u, log_rho, self.u_rho_grid_tables['T'], dtype=self.dtype)
+
+    @cached_property
+    def T3_interp(self):
+        log_alpha, log_rho = self.alpha_v_grid(n_alpha_table)
+        return grid_interpolator(log_alpha, log_rho, self.alpha_v_grid_tables['T'], fill_value=np.NaN,
+                                 dtype=self.dtype)
+
+    # finds T for a given rho and other variable from EOS table
+    def reverse_EOS_table_rho_X(self, interpolator, table, rho, X):
+        NewEOS = self.NewEOS
+
+        # find the closest rho index
+        rho_error = frac_error(NewEOS.rho, rho)
+        j = rho_error.argmin()
+
+        # find closest T index from table
+        u_error = frac_error(table[:, j], X)
+        i = u_error.argmin()
+
+        # get best guesses for the minimize function
+        rho_guess, T_guess = NewEOS.rho[j], NewEOS.T[i]
+
+        # minimize the error from the interpolator to get the result
+        error = lambda T: frac_error(interpolator(rho, T), X)
+        res = minimize(error, T_guess, method='Nelder-Mead')
+        T_res = res.x
+
+        # calculates the error for checking
+        X_check = interpolator(rho, T_res)
+        check_error = np.abs(frac_error(X_check, X))
+
+        return T_res, check_error
+
+    # finds rho and T from two other variables
+    def reverse_EOS_table_X_Y(self, interpolatorX, tableX, interpolatorY, tableY, X, Y):
+        NewEOS = self.NewEOS
+
+        # find the closest rho and T indexes
+        table_error = np.sqrt(frac_error(tableX, X) ** 2 + frac_error(tableY, Y) ** 2)
+        k = table_error.argmin()
+        ncol = table_error.shape[1]
+        i, j = int(k / ncol), int(k % ncol)
+        rho_guess, T_guess = NewEOS.rho[j], NewEOS.T[i]
+
+        # function to minimize
+        X_func = lambda z: interpolatorX(z[0], z[1])
+        Y_func = lambda z: interpolatorY(z[0], z[1])
+        error = lambda z: frac_error(X_func(z), X) ** 2 + frac_error(Y_func(z), Y) ** 2
+
+        res = minimize(error, np.array([rho_guess, T_guess]), method='Nelder-Mead')
+        rho_res, T_res = res.x
+
+        # calculates the error for checking
+        X_check = interpolatorX(rho_res, T_res)
+        Y_check = interpolatorY(rho_res, T_res)
+        check_error = np.sqrt(frac_error(X_check, X) ** 2 + frac_error(Y_check, Y) ** 2)
+
+        return rho_res, T_res, check_error
+
+    # linearly interpolates a (T, rho) EOS table at (rho, T) and also returns the gradient in (ln(rho), ln(T))
+    # (this is the same interpolation as rho_T_interpolator, so inverting it is consistent with P_EOS, S_EOS, ...)
+    def table_gradient(self, table, rho, T):
+        rho_points, T_points = self.eos_grid_tables['rho'], self.eos_grid_tables['T']
+
+        i = np.clip(np.searchsorted(rho_points, rho) - 1, 0, len(rho_points) - 2)
+        k = np.clip(np.searchsorted(T_points, T) - 1, 0, len(T_points) - 2)
+        d_rho, d_T = rho_points[i + 1] - rho_points[i], T_points[k + 1] - T_points[k]
+        a, b = (rho - rho_points[i]) / d_rho, (T - T_points[k]) / d_T
+
+        f00, f10, f01, f11 = table[k, i], table[k, i + 1], table[k + 1, i], table[k + 1, i + 1]
+        f = (1 - a) * (1 - b) * f00 + a * (1 - b) * f10 + (1 - a) * b * f01 + a * b * f11
+        df_drho = ((1 - b) * (f10 - f00) + b * (f11 - f01)) / d_rho
+        df_dT = ((1 - a) * (f01 - f00) + a * (f11 - f10)) / d_T
+
+        return f, rho * df_drho, T * df_dT
+
+    # kd-tree of the (X, Y) values of the (T, rho) table points, used to find starting guesses for invert_rho_T
+    # only every stride-th table point in each direction is included
+    def table_index(self, table_X, table_Y, stride=1):
+        from scipy.spatial import cKDTree
+        table_X, table_Y = table_X[::stride, ::stride], table_Y[::stride, ::stride]
+
+        # log-like scaling so that values over many orders of magnitude are compared fairly
+        def scaling(table):
+            floor = np.min(np.abs(table[table != 0]))
+            ptp = np.ptp(np.arcsinh(table / floor))
+            return lambda values: np.arcsinh(values / floor) / ptp
+
+        scale_X, scale_Y = scaling(table_X), scaling(table_Y)
+        tree = cKDTree(np.stack((scale_X(table_X).ravel(), scale_Y(table_Y).ravel()), axis=-1))
+
+        T_points, rho_points = np.meshgrid(self.eos_grid_tables['T'][::stride], self.eos_grid_tables['rho'][::stride],
+                                           indexing='ij')
+        return SimpleNamespace(tree=tree, scale_X=scale_X, scale_Y=scale_Y, rho=rho_points.ravel(), T=T_points.ravel())
+
+    # finds the (rho, T) table point closest to each pair of (X, Y) values, used as a starting guess
+    def nearest_table_point(self, table_X, table_Y, X, Y, index=None):
+        index = self.table_index(table_X, table_Y) if index is None else index
+        k = index.tree.query(np.stack((index.scale_X(X), index.scale_Y(Y)), axis=-1))[1]
+        return index.rho[k], index.T[k]
+
+    # finds rho and T from arrays of two other variables X and Y tabulated on the (rho, T) grid (e.g. S and P)
+    # solves every point at once with a damped Newton iteration in (ln(rho), ln(T))
+    # returns rho, T, the fractional error of each point and a mask of the points that converged
+    # a table_index of the tables can be given for the starting guesses (one is made otherwise)
+    def invert_rho_T(self, table_X, table_Y, X, Y, tol=1e-8, max_iter=50, max_step=1.0, guess_index=None):
+        rho_points, T_points = self.eos_grid_tables['rho'], self.eos_grid_tables['T']
+
+        X, Y = np.broadcast_arrays(np.asarray(X, dtype=float), np.asarray(Y, dtype=float))
+        shape = X.shape
+        X, Y = X.ravel(), Y.ravel()
+        X_scale, Y_scale = np.where(X != 0, np.abs(X), 1), np.where(Y != 0, np.abs(Y), 1)
+
+        ln_rho_range = np.log(rho_points[0]), np.log(rho_points[-1])
+        ln_T_range = np.log(T_points[0]), np.log(T_points[-1])
+
+        # fractional error of each component and the derivatives of the error
+        def residual(ln_rho, ln_T, index):
+            rho, T = np.exp(ln_rho), np.exp(ln_T)
+            fX, dX_drho, dX_dT = self.table_gradient(table_X, rho, T)
+            fY, dY_drho, dY_dT = self.table_gradient(table_Y, rho, T)
+            rX, rY = (fX - X[index]) / X_scale[index], (fY - Y[index]) / Y_scale[index]
+            J = (dX_drho / X_scale[index], dX_dT / X_scale[index], dY_drho / Y_scale[index], dY_dT / Y_scale[index])
+            return rX, rY, J
+
+        # points with a non-finite X or Y are not solved, they are returned with rho = T = NaN and infinite error
+        finite = np.isfinite(X) & np.isfinite(Y)
+        rho_guess, T_guess = np.full_like(X, rho_points[0]), np.full_like(X, T_points[0])
+        rho_guess[finite], T_guess[finite] = self.nearest_table_point(table_X, table_Y, X[finite], Y[finite],
+                                                                      index=guess_index)
+        ln_rho, ln_T = np.log(rho_guess), np.log(T_guess)
+        error = np.full_like(X, np.inf)
+        converged = np.zeros_like(X, dtype=bool)
+        active = np.flatnonzero(finite)
+
+        for iteration in range(max_iter):
+
+            rX, rY, (J11, J12, J21, J22) = residual(ln_rho[active], ln_T[active], active)
+            error[active] = np.hypot(rX, rY)
+
+            # removes converged points from the iteration
+            done = error[active] < tol
+            converged[active[done]] = True
+            keep = ~done
+            active, rX, rY = active[keep], rX[keep], rY[keep]
+            J11, J12, J21, J22 = J11[keep], J12[keep], J21[keep], J22[keep]
+            if active.size == 0:
+                break
+
+            # Newton step, limited in size so that the kinks in the linear interpolation do not throw it off
+            det = J11 * J22 - J12 * J21
+            det = np.where(det != 0, det, np.inf)
+            d_ln_rho, d_ln_T = -(J22 * rX - J12 * rY) / det, -(J11 * rY - J21 * rX) / det
+            step = np.maximum(np.hypot(d_ln_rho, d_ln_T) / max_step, 1)
+            d_ln_rho, d_ln_T = d_ln_rho / step, d_ln_T / step
+
+            # halves the step for points where it does not reduce the error
+            factor = np.ones_like(d_ln_rho)
+            for halving in range(5):
+                new_ln_rho = np.clip(ln_rho[active] + factor * d_ln_rho, *ln_rho_range)
+                new_ln_T = np.clip(ln_T[active] + factor * d_ln_T, *ln_T_range)
+                new_rX, new_rY, _ = residual(new_ln_rho, new_ln_T, active)
+                worse = np.hypot(new_rX, new_rY) >= error[active]
+                if not np.any(worse):
+                    break
+                factor = np.where(worse, factor / 2, factor)
+
+            ln_rho[active], ln_T[active] = new_ln_rho, new_ln_T
+
+        if active.size > 0:
+            rX, rY, _ = residual(ln_rho[active], ln_T[active], active)
+            error[active] = np.hypot(rX, rY)
+            converged[active] = error[active] < tol
+
+        ln_rho[~finite], ln_T[~finite] = np.NaN, np.NaN
+
+        return (np.exp(ln_rho).reshape(shape), np.exp(ln_T).reshape(shape),
+                error.reshape(shape), converged.reshape(shape))
+
+    # a (T, rho) table of one of the solve_variables on the grid of the EOS table, as used by invert_rho_T
+    def solve_table(self, name):
+        tables = self.eos_grid_tables
+        shape = (len(tables['T']), len(tables['rho']))
+        if name == 'rho':
+            return np.broadcast_to(tables['rho'], shape)
+        elif name == 'T':
+            return np.broadcast_to(tables['T'][:, None], shape)
+        return tables[name].T
+
+    # finds the state from arrays of any two of P, S, u, rho and T, e.g. solve({'P': P, 'u': u})
+    # returns a dictionary of the fields asked for (any of the solve_variables and 'cs'), with the fractional error
+    # of the solution ('error') and a mask of the points that converged to within tol ('converged')
+    # all the points are solved at once by invert_rho_T, starting from the nearest point of a coarse table index that
+    # is made once for each pair of given variables
+    def solve(self, given, fields=('rho', 'T', 'P', 'S', 'u'), tol=1e-8, max_iter=50):
+        names = list(given.keys())
+        if len(names) != 2 or not all(name in solve_variables for name in names):
+            raise ValueError(f'Two of {solve_variables} must be given, not {names}')
+        X_name, Y_name = names
+
+        if set(names) == {'rho', 'T'}:
+            rho, T = np.broadcast_arrays(np.asarray(given['rho'], dtype=float), np.asarray(given['T'], dtype=float))
+            error, converged = np.zeros_like(rho), np.ones_like(rho, dtype=bool)
+        else:
+            table_X, table_Y = self.solve_table(X_name), self.solve_table(Y_name)
+            if (X_name, Y_name) not in self.solve_indexes:
+                self.solve_indexes[X_name, Y_name] = self.table_index(table_X, table_Y, stride=solve_index_stride)
+            rho, T, error, converged = self.invert_rho_T(table_X, table_Y, given[X_name], given[Y_name], tol=tol,
+                                                         max_iter=max_iter, guess_index=self.solve_indexes[X_name, Y_name])
+
+        state = {'rho': rho, 'T': T}
+        rho_T_fields = [f for f in fields if f not in state]
+        if len(rho_T_fields) > 0:
+            state.update(self.state_from_rhoT(rho, T, fields=rho_T_fields))
+
+        result = {f: state[f] for f in fields}
+        result['error'], result['converged'] = error, converged
+        return result
+
+    # generates numpy arrays for rho and T (and the error) as functions of S and P to be used in an interpolator
+    # solver='newton' inverts the EOS table for the whole grid at once,
+    # solver='nelder-mead' minimises each point separately using woma (much slower)
+    # the grid is split between a pool of processes if processes is given
+    def generate_table_S_P(self, n=10, solver='newton', plot=True, processes=None):
+        if plot:
+            import matplotlib.pyplot as plt
+
+        NewEOS = self.NewEOS
+
+        # produces table points to be calculated
+        S, logP = self.S_P_grid(n)
+        x, y = np.meshgrid(S, logP)
 
-        arr = np.array([arr1, arr2])
+        print('Generating SP EOS table:')
 
-        if arr1.ndim == 1:
-            return np.transpose(arr, axes=(1, 0))
-        elif arr1.ndim == 2:
-            return np.transpose(arr, axes=(1, 2, 0))
+        if solver == 'newton':
+            rho_table, T_table, error_table, converged = \
+                map_rows(lambda x, y: self.invert_rho_T(NewEOS.S, NewEOS.P, x, 10 ** y), x, y, processes=processes)
+            print(f'{np.sum(~converged)} of {converged.size} points did not converge')
 
-    else:
+        elif solver == 'nelder-mead':
+            import woma
+            woma.load_eos_tables()
 
-        if type(arr1) is np.ndarray:
-            if arr1.ndim == 1:
-                arr1 = arr1[0]
+            rho_table, T_table = np.zeros_like(x), np.zeros_like(x)
+            error_table = np.zeros_like(x)
 
-        if type(arr2) is np.ndarray:
-            if arr2.ndim == 1:
-                arr2 = arr2[0]
+            S_woma = lambda rho, T: woma.s_rho_T(rho, T, self.woma_id)
+            P_woma = lambda rho, T: woma.P_T_rho(T, rho, self.woma_id)
 
-        return np.array([arr1, arr2])
+            @globalize
+            def task(i):
+                print(f'Start {i}')
+                for j in range(x.shape[1]):
+                    rho_table[i, j], T_table[i, j], error_table[i, j] = \
+                        self.reverse_EOS_table_X_Y(S_woma, NewEOS.S, P_woma, NewEOS.P, x[i, j], 10 ** y[i, j])
+                print(f'Done {i}')
+                return rho_table[i, :], T_table[i, :], error_table[i, :], i
 
+            # fills table values
+            pool = Pool(processes or 7)
+            results = pool.map(task, range(x.shape[0]))
 
-# EOS functions using the interpolators created in the previous code
-P_EOS = lambda rho, T: P_interp(make_into_pair_array(rho, T))
-S_EOS = lambda rho, T: S_interp(make_into_pair_array(rho, T))
-u_EOS = lambda rho, T: u_interp(make_into_pair_array(rho, T))
-cs_EOS = lambda rho, T: cs_interp(make_into_pair_array(rho, T))
-rho_EOS = lambda S, P: np.maximum(rho_interp(make_into_pair_array(S, np.log10(P))), 0)
-T1_EOS = lambda S, P: T_interp(make_into_pair_array(S, np.log10(P)))
-T2_EOS = lambda u, rho: T2_interp(make_into_pair_array(u, np.log10(rho)))
+            for r in results:
+                i = r[3]
+                rho_table[i, :] = r[0]
+                T_table[i, :] = r[1]
+                error_table[i, :] = r[2]
+
+        else:
+            raise ValueError(f'Unknown solver {solver}')
+
+        if plot:
+            plt.contourf(x, y, np.log10(rho_table), 80, cmap='cubehelix')
+            plt.colorbar()
+            plt.show()
+
+        if plot:
+            plt.contourf(S, logP, np.log10(error_table), 80)
+            plt.colorbar()
+            plt.show()
+
+        cell_error = self.S_P_cell_error(x, y, rho_table, T_table, error_table)
+
+        return {'rho': rho_table, 'T': T_table, 'error': error_table, 'cell_error': cell_error}
+
+    # error of each cell of an (S, P) table on the (S, log(P)) grid x, y, the larger of the error at the corners and
+    # the round trip error at the centre
+    def S_P_cell_error(self, x, y, rho_table, T_table, error_table):
+        rho_centre, T_centre = cell_centres(rho_table), cell_centres(T_table)
+        S_centre, P_centre = cell_centres(x), 10 ** cell_centres(y)
+        S_interp, P_interp = self.reference_interpolator(self.NewEOS.S), self.reference_interpolator(self.NewEOS.P)
+        centre_error = np.hypot(frac_error(S_interp(rho_centre, T_centre), S_centre),
+                                frac_error(P_interp(rho_centre, T_centre), P_centre))
+        return np.maximum(centre_error, cell_max(error_table))
+
+    # files of the (S, P) tables of n points built by the original woma (Nelder-Mead) code, which took hours to make
+    def legacy_S_P_files(self, n):
+        return f'{self.table_dir}/rho_SP_table_n_{n}.npy', f'{self.table_dir}/T_SP_table_n_{n}.npy'
+
+    # loads the legacy (S, P) tables, which have the layout of generate_table_S_P on the current S_P_grid but were
+    # saved without their error, so the error of each point is found from its round trip through the EOS table
+    def load_legacy_S_P_table(self, n):
+        print('Importing the legacy SP EOS table...')
+        rho_file, T_file = self.legacy_S_P_files(n)
+        rho_table, T_table = np.load(rho_file), np.load(T_file)
+
+        x, y = np.meshgrid(*self.S_P_grid(n))
+        S_interp, P_interp = self.reference_interpolator(self.NewEOS.S), self.reference_interpolator(self.NewEOS.P)
+        error_table = np.hypot(frac_error(S_interp(rho_table, T_table), x),
+                               frac_error(P_interp(rho_table, T_table), 10 ** y))
+        cell_error = self.S_P_cell_error(x, y, rho_table, T_table, error_table)
+
+        return {'rho': rho_table, 'T': T_table, 'error': error_table, 'cell_error': cell_error}
+
+    # finds T for arrays of rho and another variable X that increases monotonically with T at fixed rho (e.g. u)
+    # exactly inverts the linear table interpolation with a bisection over the T axis done for every point at once
+    def invert_T_rho_X(self, table, rho, X):
+        NewEOS = self.NewEOS
+
+        rho, X = np.broadcast_arrays(np.asarray(rho, dtype=float), np.asarray(X, dtype=float))
+
+        # enforces monotonicity so that small wiggles in the table cannot break the bisection
+        table = np.maximum.accumulate(table, axis=0)
+
+        # the values of X along T at each rho, linearly interpolated between the density columns
+        i = np.clip(np.searchsorted(NewEOS.rho, rho) - 1, 0, NewEOS.ND - 2)
+        a = np.clip((rho - NewEOS.rho[i]) / (NewEOS.rho[i + 1] - NewEOS.rho[i]), 0, 1)
+        column = lambda k: (1 - a) * table[k, i] + a * table[k, i + 1]
+
+        # finds the T cell containing X
+        low, high = np.zeros_like(i), np.full_like(i, NewEOS.NT - 1)
+        while np.any(high - low > 1):
+            middle = (low + high) // 2
+            below = column(middle) <= X
+            low, high = np.where(below, middle, low), np.where(below, high, middle)
+
+        # solves the linear interpolation within the cell, values beyond the table are given the edge temperatures
+        X_low, X_high = column(low), column(high)
+        b = np.clip((X - X_low) / np.where(X_high > X_low, X_high - X_low, np.inf), 0, 1)
+        T = NewEOS.T[low] + b * (NewEOS.T[high] - NewEOS.T[low])
+
+        return T
+
+    # generates a numpy array for T as functions of rho and u to be used in an interpolator
+    # solver='direct' inverts the EOS table directly for the whole grid at once,
+    # solver='woma' calls woma for each point (much slower)
+    # the grid is split between a pool of processes if processes is given
+    def generate_table_u_rho(self, n=10, solver='direct', processes=None):
+
+        # produces table points to be calculated
+        u, log_rho = self.u_rho_grid(n)
+        x, y = np.meshgrid(u, log_rho)
 
+        print('Generating u rho EOS table:')
 
-# generates the table if this file in run on its own, otherwise loads the pre-generated table
-if __name__ == '__main__':
-    woma.load_eos_tables(['ANEOS_forsterite'])
-    generate_table_u_rho(load_from_file=False, n=800)
-    generate_table_S_P(load_from_file=False, n=400)
-else:
-    generate_table_u_rho(load_from_file=True, n=800)
-    generate_table_S_P(load_from_file=True, n=400)
-
-
-# PHASE CALCULATIONS HERE #
-
-# interpolators for the vapor curves
-S_vc = np.concatenate([[0], np.flip(NewEOS.vc.Sl), NewEOS.vc.Sv])
-P_vc = np.concatenate([[1e-7], np.flip(NewEOS.vc.Pl), NewEOS.vc.Pv])
-P_vapor_curve = interp1d(S_vc, P_vc, bounds_error=False, fill_value=np.NaN)
-S_vapor_curve_l = interp1d(NewEOS.vc.Pl, NewEOS.vc.Sl, bounds_error=False, fill_value=np.NaN)
-S_vapor_curve_v = interp1d(NewEOS.vc.Pv, NewEOS.vc.Sv, bounds_error=False, fill_value=np.NaN)
-rho_vapor_curve_l = interp1d(NewEOS.vc.Pl, NewEOS.vc.rl, bounds_error=False, fill_value=np.NaN)
-
-# for a given value of S and P, returns the S value of the condensation point
-# (or returns the input S if above the critical point)
-def condensation_S(S, P):
-    return np.where(P < P_critical_point, S_vapor_curve_v(P), S)
-
-
-# returns the phase of the forsterite as an integer flag defined as:
-# 0 : invalid region, 1 : liquid/solid, 2 : liquid vapor mix, 3 : vapor, 4 : supercritical
-def phase(S, P):
-    min_P = 1e-5  # pressures below this are invalid
-
-    result = np.zeros_like(P)
-    result = np.where(P <= min_P, 0, result)
-    result = np.where(np.logical_and(P < P_vapor_curve(S), P > min_P), 2, result)
-    result = np.where(np.logical_and(P >= P_vapor_curve(S), S < S_critical_point), 1, result)
-    result = np.where(np.logical_and(P >= P_vapor_curve(S), S >= S_critical_point), 3, result)
-    result = np.where(np.logical_and(result == 3, P >= P_critical_point), 4, result)
+        if solver == 'direct':
+            NewEOS = self.NewEOS
+            T_table = map_rows(lambda x, y: (self.invert_T_rho_X(NewEOS.U, 10 ** y, x),), x, y, processes=processes)[0].T
 
-    return result
+        elif solver == 'woma':
+            import woma
+            woma.load_eos_tables()
 
+            T_table = np.zeros_like(x)
 
-# returns the vapor quality at a give (S, P)
-# returns 0 if no vapor present and 1 if all vapor
-def vapor_quality(S, P):
+            @globalize
+            def task(i):
+                print(f'Start {i}')
+                for j in range(x.shape[1]):
+                    T_table[j, i] = woma.T_u_rho(x[i, j], 10 ** y[i, j], self.woma_id)
+                print(f'Done {i}')
+                return T_table[:, i], i
 
-    Sl = S_vapor_curve_l(P)
-    Sv = S_vapor_curve_v(P)
+            # fills table values
+            pool = Pool(processes or 7)
+            results = pool.map(task, range(x.shape[0]))
 
-    vq = (S - Sl) / (Sv - Sl)
-    p = phase(S, P)
-    result = np.where(p == 2, vq, np.NaN)
-    result = np.where(p == 1, 0, result)
-    result = np.where(p == 3, 1, result)
-    return result
+            for r in results:
+                i = r[1]
+                T_table[:, i] = r[0]
+
+        else:
+            raise ValueError(f'Unknown solver {solver}')
+
+        # fractional error in u at each point (relative to 1 J/kg at u = 0)
+        u_grid, rho_grid = x.T, 10 ** y.T
+        u_interp = self.reference_interpolator(self.NewEOS.U)
+        error_table = np.abs(u_interp(rho_grid, T_table) - u_grid) / np.where(u_grid != 0, np.abs(u_grid), 1)
+
+        # error of each cell, the larger of the error at the corners and the round trip error at the centre
+        u_centre = cell_centres(u_grid)
+        centre_error = frac_error(u_interp(10 ** cell_centres(y.T), cell_centres(T_table)), u_centre)
+        cell_error = np.maximum(centre_error, cell_max(error_table))
+
+        return {'T': T_table, 'error': error_table, 'cell_error': cell_error}
+
+    # EOS functions using the interpolators
+    # the result is written into out if an array is given
+    @memoised
+    @chunked
+    def P_EOS(self, rho, T, out=None):
+        return self.P_interp(rho, T, out=out)
+
+    @memoised
+    @chunked
+    def S_EOS(self, rho, T, out=None):
+        return self.S_interp(rho, T, out=out)
+
+    @memoised
+    @chunked
+    def u_EOS(self, rho, T, out=None):
+        return self.u_interp(rho, T, out=out)
+
+    @memoised
+    @chunked
+    def cs_EOS(self, rho, T, out=None):
+        return self.cs_interp(rho, T, out=out)
+
+    @memoised
+    @chunked
+    def rho_EOS(self, S, P, out=None):
+        rho, = self.SP_interpolate(S, P, fields=['rho'], out=[out])
+        return np.maximum(rho, 0, out=rho)
+
+    @memoised
+    @chunked
+    def T1_EOS(self, S, P, out=None):
+        T, = self.SP_interpolate(S, P, fields=['T'], out=[out])
+        return T
+
+    # interpolates the (S, P) -> (rho, T) tables for a list of fields ('rho' and/or 'T'), returns a list of arrays
+    # if SP_phase_split is set the tables are only used for the single phase regions: inside the liquid-vapor dome
+    # the state is given by the lever rule between the saturated liquid and vapor at P, and in table cells cut by the
+    # edge of the dome, points are interpolated in S between the single phase table node and the edge of the dome
+    # this avoids interpolating across the phase boundary without needing finer tables
+    def SP_interpolate(self, S, P, fields=('rho', 'T'), out=None):
+        interpolators = {'rho': self.rho_interp, 'T': self.T_interp}
+        out = [None] * len(fields) if out is None else out
+
+        cell = self.S_logP_grid.cell(S, np.log10(P))
+        values = [interpolators[f].at(cell, out=o) for f, o in zip(fields, out)]
+
+        if SP_phase_split:
+            self.correct_SP_dome(S, P, cell, fields, values)
+
+        return values
+
+    # overwrites the interpolated values in and around the liquid-vapor dome (see SP_interpolate)
+    def correct_SP_dome(self, S, P, cell, fields, values):
+        interpolators = {'rho': self.rho_interp, 'T': self.T_interp}
+        S, P = np.broadcast_arrays(np.atleast_1d(S), np.atleast_1d(P))
+        k, tx, ty = (np.broadcast_to(a, S.shape) for a in cell)  # the weights of a scalar S or P are not broadcast
+
+        # the S values of the table nodes either side of each point
+        S_points = self.S_logP_grid.x_axis.points
+        i = k // self.S_logP_grid.y_axis.n
+        S_low, S_high = S_points[i], S_points[i + 1]
+
+        with np.errstate(invalid='ignore'):
+            Sl, Sv = self.S_vapor_curve_l(P), self.S_vapor_curve_v(P)
+            mixed = (S >= Sl) & (S <= Sv)
+            liquid_edge = (S < Sl) & (S_high > Sl)
+            vapor_edge = (S > Sv) & (S_low < Sv)
+
+        # lever rule inside the dome
+        if np.any(mixed):
+            P_m = P[mixed]
+            q = (S[mixed] - Sl[mixed]) / (Sv[mixed] - Sl[mixed])
+            for f, v in zip(fields, values):
+                if f == 'rho':
+                    v[mixed] = 1 / ((1 - q) / self.rho_vapor_curve_l(P_m) + q / self.rho_vapor_curve_v(P_m))
+                else:
+                    v[mixed] = (1 - q) * self.T_vapor_curve_l(P_m) + q * self.T_vapor_curve_v(P_m)
+
+        # interpolates from the liquid node below the dome edge up to the saturated liquid
+        if np.any(liquid_edge):
+            P_l, S_node = P[liquid_edge], S_low[liquid_edge]
+            w = (S[liquid_edge] - S_node) / (Sl[liquid_edge] - S_node)
+            node_cell = k[liquid_edge], np.zeros_like(tx[liquid_edge]), ty[liquid_edge]
+            for f, v in zip(fields, values):
+                node = interpolators[f].at(node_cell)
+                edge = self.rho_vapor_curve_l(P_l) if f == 'rho' else self.T_vapor_curve_l(P_l)
+                v[liquid_edge] = node + w * (edge - node)
+
+        # interpolates from the saturated vapor up to the vapor node above the dome edge
+        if np.any(vapor_edge):
+            P_v, S_node = P[vapor_edge], S_high[vapor_edge]
+            w = (S[vapor_edge] - Sv[vapor_edge]) / (S_node - Sv[vapor_edge])
+            node_cell = k[vapor_edge], np.ones_like(tx[vapor_edge]), ty[vapor_edge]
+            for f, v in zip(fields, values):
+                node = interpolators[f].at(node_cell)
+                edge = self.rho_vapor_curve_v(P_v) if f == 'rho' else self.T_vapor_curve_v(P_v)
+                v[vapor_edge] = edge + w * (node - edge)
+
+    @memoised
+    @chunked
+    def T2_EOS(self, u, rho, out=None):
+        return self.T2_interp(u, np.log10(rho), out=out)
+
+    # returns one of the derivative_fields at (rho, T) in SI units, interpolated from the derivatives at the table points
+    # (the derivatives are tabulated with respect to ln(rho) and ln(T), and divided by rho or T here)
+    def EOS_derivative(self, name, rho, T, cell=None):
+        cell = self.rho_T_grid.cell(rho, T) if cell is None else cell
+        result = self.derivative_interps[name].at(cell)
+        if name.endswith('_drho'):
+            result /= rho
+        elif name.endswith('_dT'):
+            result /= T
+        return result
+
+    @memoised
+    @chunked
+    def dP_drho_EOS(self, rho, T):
+        return self.EOS_derivative('dP_drho', rho, T)
+
+    @memoised
+    @chunked
+    def dP_dT_EOS(self, rho, T):
+        return self.EOS_derivative('dP_dT', rho, T)
+
+    @memoised
+    @chunked
+    def dS_drho_EOS(self, rho, T):
+        return self.EOS_derivative('dS_drho', rho, T)
+
+    @memoised
+    @chunked
+    def dS_dT_EOS(self, rho, T):
+        return self.EOS_derivative('dS_dT', rho, T)
+
+    # specific heat capacity at constant volume
+    @memoised
+    @chunked
+    def cv_EOS(self, rho, T):
+        return self.EOS_derivative('cv', rho, T)
+
+    # ANEOS phase flag (KPA) of the table point nearest to (rho, T)
+    @memoised
+    @chunked
+    def KPA_EOS(self, rho, T):
+        return self.KPA_interp.nearest(self.rho_T_grid.cell(rho, T)).astype(int)
+
+    # calculates several variables from (rho, T) at once, finding the table cell of each point only once
+    # fields can be any of 'P', 'S', 'u', 'cs' and the derivative_fields, returns a dictionary of arrays
+    @memoised
+    @chunked
+    def state_from_rhoT(self, rho, T, fields=('P', 'S', 'u', 'cs')):
+        interpolators = {'P': self.P_interp, 'S': self.S_interp, 'u': self.u_interp, 'cs': self.cs_interp}
+        cell = self.rho_T_grid.cell(rho, T)
+        return {f: self.EOS_derivative(f, rho, T, cell=cell) if f in derivative_fields else interpolators[f].at(cell)
+                for f in fields}
+
+    # calculates several variables from (S, P) at once, finding the table cell of each point only once per table
+    # fields can be 'rho', 'T' and any of the fields of state_from_rhoT, returns a dictionary of arrays
+    @memoised
+    @chunked
+    def state_from_SP(self, S, P, fields=('rho', 'T', 'u')):
+        rho, T = self.SP_interpolate(S, P, fields=['rho', 'T'])
+        state = {'rho': np.maximum(rho, 0, out=rho), 'T': T}
+
+        rho_T_fields = [f for f in fields if f not in state]
+        if len(rho_T_fields) > 0:
+            state.update(self.state_from_rhoT(state['rho'], state['T'], fields=rho_T_fields))
+
+        return {f: state[f] for f in fields}
+
+    # PHASE CALCULATIONS HERE #
+
+    # interpolators for the vapor curves
+    @cached_property
+    def P_vapor_curve(self):
+        vc = self.vapor_curve
+        S_vc = np.concatenate([[0], np.flip(vc.Sl), vc.Sv])
+        P_vc = np.concatenate([[1e-7], np.flip(vc.Pl), vc.Pv])
+        return interp1d(S_vc, P_vc, bounds_error=False, fill_value=np.NaN)
+
+    @cached_property
+    def S_vapor_curve_l(self):
+        vc = self.vapor_curve
+        return interp1d(vc.Pl, vc.Sl, bounds_error=False, fill_value=np.NaN)
+
+    @cached_property
+    def S_vapor_curve_v(self):
+        vc = self.vapor_curve
+        return interp1d(vc.Pv, vc.Sv, bounds_error=False, fill_value=np.NaN)
+
+    @cached_property
+    def rho_vapor_curve_l(self):
+        vc = self.vapor_curve
+        return interp1d(vc.Pl, vc.rl, bounds_error=False, fill_value=np.NaN)
+
+    @cached_property
+    def rho_vapor_curve_v(self):
+        vc = self.vapor_curve
+        return interp1d(vc.Pv, vc.rv, bounds_error=False, fill_value=np.NaN)
+
+    @cached_property
+    def T_vapor_curve_l(self):
+        vc = self.vapor_curve
+        return interp1d(vc.Pl, vc.T, bounds_error=False, fill_value=np.NaN)
+
+    @cached_property
+    def T_vapor_curve_v(self):
+        vc = self.vapor_curve
+        return interp1d(vc.Pv, vc.T, bounds_error=False, fill_value=np.NaN)
+
+    # for a given value of S and P, returns the S value of the condensation point
+    # (or returns the input S if above the critical point)
+    @memoised
+    @chunked
+    def condensation_S(self, S, P):
+        return np.where(P < self.P_critical_point, self.S_vapor_curve_v(P), S)
+
+    # returns the phase of the material as an integer flag defined as:
+    # 0 : invalid region, 1 : liquid/solid, 2 : liquid vapor mix, 3 : vapor, 4 : supercritical
+    @memoised
+    @chunked
+    def phase(self, S, P):
+        min_P = 1e-5  # pressures below this are invalid
+
+        result = np.zeros_like(P)
+        result = np.where(P <= min_P, 0, result)
+        result = np.where(np.logical_and(P < self.P_vapor_curve(S), P > min_P), 2, result)
+        result = np.where(np.logical_and(P >= self.P_vapor_curve(S), S < self.S_critical_point), 1, result)
+        result = np.where(np.logical_and(P >= self.P_vapor_curve(S), S >= self.S_critical_point), 3, result)
+        result = np.where(np.logical_and(result == 3, P >= self.P_critical_point), 4, result)
+
+        return result
+
+    # returns the vapor quality at a give (S, P)
+    # returns 0 if no vapor present and 1 if all vapor
+    @memoised
+    @chunked
+    def vapor_quality(self, S, P):
+
+        Sl = self.S_vapor_curve_l(P)
+        Sv = self.S_vapor_curve_v(P)
+
+        vq = (S - Sl) / (Sv - Sl)
+        p = self.phase(S, P)
+        result = np.where(p == 2, vq, np.NaN)
+        result = np.where(p == 1, 0, result)
+        result = np.where(p == 3, 1, result)
+        return result
+
+    # returns the density of the liquid at given pressure
+    @memoised
+    @chunked
+    def rho_liquid(self, P):
+        return self.rho_vapor_curve_l(P)
+
+    # returns the liquid volume fraction of a vapor at a given (rho, P, S)
+    @memoised
+    @chunked
+    def liquid_volume_fraction(self, rho, P, S):
+        q = self.vapor_quality(S, P)
+        rho_l = self.rho_vapor_curve_l(P)
+        lvf = (1 - q) * (rho / rho_l)
+        return lvf
+
+    # returns the density of the vapor at given (rho, P, S)
+    @memoised
+    @chunked
+    def rho_vapor(self, rho, S, P):
+        q = self.vapor_quality(S, P)
+        rho_l = self.rho_vapor_curve_l(P)
+
+        return q * ((1/rho) - ((1 - q)/rho_l)) ** -1
+
+    # ABSORPTION CALCULATIONS HERE #
+    # absorption (alpha) is defined here as the optical attenuation coeffcient
+
+    # calculates the absorption of the liquid droplets
+    @memoised
+    @chunked
+    def alpha_l(self, rho, P, S, D0):
+        # uses the lever rule to calculate the vapor quality
+        q = self.vapor_quality(S, P)
+
+        # calculates the liquid volume fraction from the vapor quality
+        rho_l = self.rho_vapor_curve_l(P)
+        lvf = (1 - q) * (rho / rho_l)
+        return (6 / (4 * D0)) * lvf
+
+    # calculates the total absorption or liquid and vapor at a given (rho, T, P, S) and droplet size
+    @memoised
+    @chunked
+    def alpha(self, rho, T, P, S, D0=1e-3):
+
+        ph = self.phase(S, P)
+
+        result = np.zeros_like(rho)
+        result = np.where(ph == 0, 0, result)
+        result = np.where(ph == 1, 1e14, result)
+        if D0 != 0:
+            result = np.where(ph == 2, alpha_v(rho, T) + self.alpha_l(rho, P, S, D0), result)
+        else:
+            result = np.where(ph == 2, alpha_v(rho, T), result)
+        result = np.where(ph >= 3, alpha_v(rho, T), result)
+
+        return result
+
+    # calculates the phase, vapor quality, liquid volume fraction and absorption at a given (rho, T, P, S) together
+    # evaluating each vapor curve interpolator and alpha_v only once, returns a dictionary of arrays with
+    # 'phase', 'vq' and 'lvf' as given by phase, vapor_quality and liquid_volume_fraction, 'alpha' as given by alpha
+    # and 'alpha_v' as given by alpha with D0=0 (i.e. the absorption without droplets)
+    @memoised
+    @chunked
+    def phase_state(self, rho, T, P, S, D0=1e-3):
+        min_P = 1e-5  # pressures below this are invalid
+
+        P_vc = self.P_vapor_curve(S)
+        Sl, Sv = self.S_vapor_curve_l(P), self.S_vapor_curve_v(P)
+        rho_l = self.rho_vapor_curve_l(P)
+
+        above_vc = P >= P_vc
+        ph = np.where(above_vc,
+                      np.where(S < self.S_critical_point, 1., np.where(P >= self.P_critical_point, 4., 3.)),
+                      np.where((P < P_vc) & (P > min_P), 2., 0.))
+        mixed = ph == 2
+
+        vq = np.where(mixed, (S - Sl) / (Sv - Sl), np.where(ph == 1, 0, np.where(ph == 3, 1, np.NaN)))
+        lvf = (1 - vq) * (rho / rho_l)
+
+        alpha_no_droplets = np.where(ph == 1, 1e14, np.where(ph >= 2, alpha_v(rho, T), 0))
+        if D0 != 0:
+            alpha_total = np.where(mixed, alpha_no_droplets + (6 / (4 * D0)) * lvf, alpha_no_droplets)
+        else:
+            alpha_total = alpha_no_droplets
+
+        return {'phase': ph, 'vq': vq, 'lvf': lvf, 'alpha': alpha_total, 'alpha_v': alpha_no_droplets}
+
+    # generates a table to calculate T for a given rho and alpha_v, with shape (n_alpha, n_rho)
+    # solver='lambertw' inverts alpha_v in closed form for the whole grid at once,
+    # solver='root' solves for each point separately (slow, kept for comparison)
+    def generate_table_alpha_v(self, n=50, solver='lambertw'):
+
+        log_alpha, log_rho = self.alpha_v_grid(n)
+        x, y = np.meshgrid(log_alpha, log_rho, indexing='ij')
+
+        if solver == 'lambertw':
+            return {'T': T_from_alpha_v(10 ** y, 10 ** x)}
 
+        T_table = np.zeros_like(x)
 
-# returns the density of the liquid at given pressure
-def rho_liquid(P):
-    return rho_vapor_curve_l(P)
+        for i in range(n):
+            for j in range(n):
+                r = 10 ** y[i, j]
+                a = 10 ** x[i, j]
+                res = root(lambda T: alpha_v(r, T) - a, 3000)
+                if res.success:
+                    T_table[i, j] = res.x
+                else:
+                    T_table[i, j] = 0
 
+        return {'T': T_table}
 
-# returns the liquid volume fraction of a vapor at a given (rho, P, S)
-def liquid_volume_fraction(rho, P, S):
-    q = vapor_quality(S, P)
-    rho_l = rho_vapor_curve_l(P)
-    lvf = (1 - q) * (rho / rho_l)
-    return lvf
+    # returns the fractional error of a derived table at each point, the largest error of the inverse in its table cell
+    # table='S_P' for the (S, P) -> (rho, T) tables, or table='u_rho' for the (u, rho) -> T table with X=u and Y=rho
+    # points outside the table have infinite error, inside the liquid-vapor dome the S-P tables have no error if
+    # SP_phase_split is set, as they are not used there
+    def table_error(self, X, Y, table='S_P'):
+        if table == 'S_P':
+            grid, cell_error = self.S_logP_grid, self.S_P_table['cell_error'].T
+            k, tx, ty = grid.cell(X, np.log10(Y))
+        elif table == 'u_rho':
+            grid, cell_error = self.T2_interp.grid, self.u_rho_table['cell_error']
+            k, tx, ty = grid.cell(X, np.log10(Y))
+        else:
+            raise ValueError(f'Unknown table {table}')
 
+        ny = grid.y_axis.n
+        error = np.asarray(cell_error)[k // ny, k % ny]
+        error[(tx < 0) | (tx > 1) | (ty < 0) | (ty > 1)] = np.inf
 
-# returns the density of the vapor at given (rho, P, S)
-def rho_vapor(rho, S, P):
-    q = vapor_quality(S, P)
-    rho_l = rho_vapor_curve_l(P)
+        if table == 'S_P' and SP_phase_split:
+            S, P = np.broadcast_arrays(np.atleast_1d(X), np.atleast_1d(Y))
+            with np.errstate(invalid='ignore'):
+                error[(S >= self.S_vapor_curve_l(P)) & (S <= self.S_vapor_curve_v(P))] = 0
 
-    return q * ((1/rho) - ((1 - q)/rho_l)) ** -1
+        return error
 
+    # wrapper function for the T(alpha_v, rho) interpolator
+    @memoised
+    @chunked
+    def T_alpha_v(self, rho, alpha_v):
+        return self.T3_interp(np.log10(alpha_v), np.log10(rho))
 
-# ABSORPTION CALCULATIONS HERE #
-# absorption (alpha) is defined here as the optical attenuation coeffcient
 
-# calculates the absorption of the liquid droplets
-def alpha_l(rho, P, S, D0):
-    # uses the lever rule to calculate the vapor quality
-    q = vapor_quality(S, P)
+# the SESAME files of the materials are not included in the repository (see the README)
+forsterite = material_EOS('aneos-forsterite-2019-1.0.0', forsterite_header, 400,
+                          source='https://github.com/ststewart/aneos-forsterite-2019 (into aneos-forsterite-2019-1.0.0/)')
+iron = material_EOS('aneos-iron-2020-1.0.0', iron_header, 401,
+                    source='https://github.com/ststewart/aneos-iron-2020 (into aneos-iron-2020-1.0.0/)')
 
-    # calculates the liquid volume fraction from the vapor quality
-    rho_l = rho_vapor_curve_l(P)
-    lvf = (1 - q) * (rho / rho_l)
-    return (6 / (4 * D0)) * lvf
+# EOS of each material by its swift/woma material id (as in simulation_parameters.yml)
+materials = {400: forsterite, 401: iron}
 
 
-# calculates the absorption of the vapor
-def alpha_v(rho, T):
-    B0 = 6e17  # m^-1
-    B1, B2 = 37, -11.6
-    rho_n, T_n = 1900, 4150  # kg/m^3, K
-    r, t = rho / rho_n, T / T_n
+# turns the memo caches of all of the materials on or off, and returns their hit and miss counts
+def enable_memo(max_size=32):
+    for material in materials.values():
+        material.enable_memo(max_size)
 
-    result = B0 * (r ** (1 / 3)) * t * np.exp(-B1 / t) * np.exp(-B2 * (r / t))
 
-    return np.nan_to_num(result)
+def disable_memo():
+    for material in materials.values():
+        material.disable_memo()
 
 
-# blank interpolator to be filled in (calculates the T for a given alpha and rho)
-T3_interp = lambda x: None
+def memo_stats():
+    return {i: material.memo.stats() for i, material in materials.items() if material.memo is not None}
 
 
-# calculates the total absorption or liquid and vapor at a given (rho, T, P, S) and droplet size
-def alpha(rho, T, P, S, D0=1e-3):
+# material ids as used by by_material, rounded to the nearest integer (as mass weighted slices mix them) with NaNs
+# replaced by default_matid
+def material_ids(matid):
+    return np.rint(np.nan_to_num(np.asarray(matid, dtype=float), nan=default_matid)).astype(int)
 
-    ph = phase(S, P)
 
-    result = np.zeros_like(rho)
-    result = np.where(ph == 0, 0, result)
-    result = np.where(ph == 1, 1e14, result)
-    if D0 != 0:
-        result = np.where(ph == 2, alpha_v(rho, T) + alpha_l(rho, P, S, D0), result)
-    else:
-        result = np.where(ph == 2, alpha_v(rho, T), result)
-    result = np.where(ph >= 3, alpha_v(rho, T), result)
+# checks that there is an EOS for every material id and that its files are available, raising a ValueError for unknown
+# ids and a FileNotFoundError for missing files
+def check_materials(matid):
+    ids = np.unique(material_ids(matid))
+
+    unknown = np.setdiff1d(ids, list(materials.keys()))
+    if unknown.size > 0:
+        raise ValueError(f'No EOS for material ids {unknown}')
+
+    for i in ids:
+        materials[int(i)].check_source_files()
+
+    return ids
 
-    return result
 
+# evaluates an EOS function (given by name, e.g. 'P_EOS') for an array of material ids
+# the points of each material are grouped and evaluated in one call, functions returning dictionaries are supported
+# material ids are rounded to the nearest integer (as mass weighted slices mix them) and NaNs use default_matid
+def by_material(name, matid, *args, **kwargs):
+    arrays = np.broadcast_arrays(material_ids(matid), *[np.asarray(a) for a in args])
+    matid, args = arrays[0], arrays[1:]
 
-# generates a table to calculate T for a given rho and alpha_v
-def generate_table_alpha_v():
-    global T3_interp
+    ids = check_materials(matid)
+    if ids.size == 1:
+        return getattr(materials[int(ids[0])], name)(*args, **kwargs)
 
-    log_alpha = np.linspace(-20, 10, num=50)
-    log_rho = np.linspace(-5, 1, num=50)
-    x, y = np.meshgrid(log_alpha, log_rho)
-    T_table = np.zeros_like(x)
+    result = None
+    for i in ids:
+        mask = matid == i
+        values = getattr(materials[int(i)], name)(*[a[mask] for a in args], **kwargs)
 
-    for i in range(50):
-        for j in range(50):
-            r = 10 ** y[i, j]
-            a = 10 ** x[i, j]
-            res = root(lambda T: alpha_v(r, T) - a, 3000)
-            if res.success:
-                T_table[i, j] = res.x
+        if result is None:
+            if isinstance(values, dict):
+                result = {k: np.empty(matid.shape, dtype=np.asarray(v).dtype) for k, v in values.items()}
             else:
-                T_table[i, j] = 0
+                result = np.empty(matid.shape, dtype=np.asarray(values).dtype)
 
-    T3_interp = RegularGridInterpolator((log_alpha, log_rho), T_table, method=method, bounds_error=False, fill_value=np.NaN)
+        if isinstance(values, dict):
+            for k, v in values.items():
+                result[k][mask] = v
+        else:
+            result[mask] = values
 
+    return result
+
+
+# EOS functions for forsterite, nothing is loaded until one of these is first called
+P_EOS, S_EOS, u_EOS, cs_EOS = forsterite.P_EOS, forsterite.S_EOS, forsterite.u_EOS, forsterite.cs_EOS
+rho_EOS, T1_EOS, T2_EOS = forsterite.rho_EOS, forsterite.T1_EOS, forsterite.T2_EOS
+state_from_rhoT, state_from_SP = forsterite.state_from_rhoT, forsterite.state_from_SP
+condensation_S, phase, vapor_quality = forsterite.condensation_S, forsterite.phase, forsterite.vapor_quality
+rho_liquid, rho_vapor = forsterite.rho_liquid, forsterite.rho_vapor
+liquid_volume_fraction, alpha_l, alpha = forsterite.liquid_volume_fraction, forsterite.alpha_l, forsterite.alpha
+phase_state, table_error, solve = forsterite.phase_state, forsterite.table_error, forsterite.solve
+T_alpha_v = forsterite.T_alpha_v
+dP_drho_EOS, dP_dT_EOS, cv_EOS = forsterite.dP_drho_EOS, forsterite.dP_dT_EOS, forsterite.cv_EOS
+dS_drho_EOS, dS_dT_EOS, KPA_EOS = forsterite.dS_drho_EOS, forsterite.dS_dT_EOS, forsterite.KPA_EOS
 
-generate_table_alpha_v()
+# tables and interpolators that are accessed as module attributes (e.g. fst.NewEOS) are loaded on first access
+lazy_attributes = ['NewEOS', 'eos_grid_tables', 'S_P_grid_tables', 'u_rho_grid_tables', 'alpha_v_grid_tables',
+                   'vapor_curve',
+                   'P_critical_point', 'S_critical_point', 'S_P_table', 'u_rho_table', 'alpha_v_table',
+                   'u_interp', 'P_interp', 'S_interp', 'cs_interp', 'rho_interp', 'T_interp', 'T2_interp', 'T3_interp',
+                   'P_vapor_curve', 'S_vapor_curve_l', 'S_vapor_curve_v', 'rho_vapor_curve_l', 'rho_vapor_curve_v',
+                   'T_vapor_curve_l', 'T_vapor_curve_v']
 
 
-# wrapper function for the T(alpha_v, rho) interpolator
-def T_alpha_v(rho, alpha_v):
-    rho_alpha = make_into_pair_array(np.log10(alpha_v), np.log10(rho))
-    return T3_interp(rho_alpha)
+def __getattr__(name):
+    if name in lazy_attributes:
+        return getattr(forsterite, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+# regenerates the tables if this file in run on its own
+if __name__ == '__main__':
+    for material in materials.values():
+        if os.path.isdir(material.aneos_dir):
+            material.build_tables(rebuild=True, processes=7)
@@ -0,0 +1,150 @@
+# times the public EOS functions on arrays shaped like the photosphere grids and records the results as json
+# run as: python EOS_benchmark.py [output file] (default EOS_tables/benchmark.json)
+# each record gives the best and mean time, the throughput, the peak memory allocated during one call and, for
+# float32, the largest relative difference from the float64 results
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+import EOS as fst
+
+# (n_theta + 1, n_r) shapes of the photosphere grids
+benchmark_shapes = [(41, 250), (41, 500), (41, 1000), (101, 2000)]
+benchmark_dtypes = [np.float64, np.float32]
+
+
+# random states spread over the range of values found in the photosphere model
+def benchmark_inputs(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'rho': 10 ** rng.uniform(-6, 3.5, shape),
+        'T': 10 ** rng.uniform(2.5, 4.5, shape),
+        'S': rng.uniform(2000, 12000, shape),
+        'P': 10 ** rng.uniform(-2, 11, shape),
+        'u': 10 ** rng.uniform(5.2, 7.8, shape),
+        'alpha_v': 10 ** rng.uniform(-15, 5, shape),
+    }
+
+
+# the functions that are timed and the inputs they are called with
+benchmark_functions = {
+    'P_EOS': lambda m, x: m.P_EOS(x['rho'], x['T']),
+    'S_EOS': lambda m, x: m.S_EOS(x['rho'], x['T']),
+    'u_EOS': lambda m, x: m.u_EOS(x['rho'], x['T']),
+    'rho_EOS': lambda m, x: m.rho_EOS(x['S'], x['P']),
+    'T1_EOS': lambda m, x: m.T1_EOS(x['S'], x['P']),
+    'T2_EOS': lambda m, x: m.T2_EOS(x['u'], x['rho']),
+    'phase': lambda m, x: m.phase(x['S'], x['P']),
+    'vapor_quality': lambda m, x: m.vapor_quality(x['S'], x['P']),
+    'alpha': lambda m, x: m.alpha(x['rho'], x['T'], x['P'], x['S']),
+    'T_alpha_v': lambda m, x: m.T_alpha_v(x['rho'], x['alpha_v']),
+    'condensation_S': lambda m, x: m.condensation_S(x['S'], x['P']),
+    'state_from_SP': lambda m, x: m.state_from_SP(x['S'], x['P'])['u'],
+    'state_from_rhoT': lambda m, x: m.state_from_rhoT(x['rho'], x['T'])['P'],
+    'phase_state': lambda m, x: m.phase_state(x['rho'], x['T'], x['P'], x['S'])['alpha'],
+}
+
+
+# largest relative difference between two sets of results, ignoring points that are NaN in both
+def max_relative_difference(a, b):
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    valid = np.isfinite(a) & np.isfinite(b)
+    scale = np.maximum(np.abs(b[valid]), np.finfo(float).tiny)
+    mismatched = int(np.sum(np.isfinite(a) != np.isfinite(b)))
+    return (float(np.max(np.abs(a[valid] - b[valid]) / scale, initial=0)), mismatched)
+
+
+# times a function, returning the best and mean time of the repeats and the peak memory allocated by one call
+def time_function(f, repeats):
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), float(np.mean(times)), peak
+
+
+# current git commit, if the code is in a git repository
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# runs the benchmark for a material, returns a dictionary of the run information and one record per measurement
+def run_benchmark(material=fst.forsterite, shapes=benchmark_shapes, dtypes=benchmark_dtypes, repeats=5,
+                  functions=None):
+    functions = list(benchmark_functions) if functions is None else functions
+    initial_dtype = material.dtype
+    records = []
+
+    # float64 results, used to check the other precisions
+    reference = {}
+
+    try:
+        for dtype in dtypes:
+            material.set_dtype(dtype)
+
+            for shape in shapes:
+                inputs = benchmark_inputs(shape)
+
+                for name in functions:
+                    f = lambda: benchmark_functions[name](material, inputs)
+                    result = f()  # loads any tables the function needs
+                    best, mean, peak = time_function(f, repeats)
+
+                    record = {
+                        'function': name, 'dtype': np.dtype(dtype).name, 'shape': list(shape),
+                        'points': int(np.prod(shape)), 'repeats': repeats, 'best_seconds': best, 'mean_seconds': mean,
+                        'points_per_second': float(np.prod(shape) / best), 'peak_memory_bytes': peak,
+                    }
+
+                    if np.dtype(dtype) == np.float64:
+                        reference[name, shape] = result
+                    elif (name, shape) in reference:
+                        record['max_relative_difference'], record['nan_mismatches'] = \
+                            max_relative_difference(result, reference[name, shape])
+
+                    records.append(record)
+                    print(f"{name:>16} {record['dtype']:>8} {str(shape):>12} {best * 1e3:9.2f} ms "
+                          f"{record['points_per_second']:10.3e} points/s {peak / 2 ** 20:8.1f} MiB")
+    finally:
+        material.set_dtype(initial_dtype)
+
+    info = {
+        'material': material.header['MODELNAME'],
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'git_commit': git_commit(),
+        'python_version': platform.python_version(),
+        'numpy_version': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+    return {'info': info, 'records': records}
+
+
+if __name__ == '__main__':
+    output = sys.argv[1] if len(sys.argv) > 1 else 'EOS_tables/benchmark.json'
+
+    results = run_benchmark()
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saved benchmark results to {output}')
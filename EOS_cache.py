@@ -0,0 +1,106 @@
+# content-addressed cache for tables derived from the EOS (e.g. the (S, P) -> (rho, T) inversion tables)
+# each table is stored in a directory named by a hash of everything used to make it (the spec),
+# with one .npy file per array and a metadata.json file recording the spec and how the table was built
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+# increase this if the way tables are built changes, so that old tables are not reloaded
+cache_version = 3
+
+
+# hash of a table spec (a dictionary of json serialisable values)
+# versioned=False leaves cache_version out, for caches of other data whose specs carry their own version
+def table_key(spec, versioned=True):
+    text = json.dumps(dict(spec, cache_version=cache_version) if versioned else spec, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+# directory a table is stored in
+def table_path(cache_dir, spec, versioned=True):
+    return os.path.join(cache_dir, f"{spec['table']}_{table_key(spec, versioned)[:16]}")
+
+
+# loads the arrays of a table as a dictionary, or returns None if the table has not been made
+def load_table(cache_dir, spec, mmap_mode='r', versioned=True):
+    path = table_path(cache_dir, spec, versioned)
+
+    try:
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    # the spec is checked in full in case of a hash collision
+    if metadata['spec'] != json.loads(json.dumps(spec)):
+        return None
+
+    return {k: np.load(os.path.join(path, f'{k}.npy'), mmap_mode=mmap_mode) for k in metadata['arrays']}
+
+
+# loads the metadata of a table, or returns None if the table has not been made
+def load_metadata(cache_dir, spec, versioned=True):
+    try:
+        with open(os.path.join(table_path(cache_dir, spec, versioned), 'metadata.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# saves a dictionary of arrays as a table, along with any extra metadata
+def save_table(cache_dir, spec, arrays, metadata=None, versioned=True):
+    path = table_path(cache_dir, spec, versioned)
+
+    metadata = dict(metadata or {})
+    metadata.update({
+        'spec': spec,
+        'key': table_key(spec, versioned),
+        'arrays': {k: {'shape': list(np.shape(v)), 'dtype': str(np.asarray(v).dtype)} for k, v in arrays.items()},
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'numpy_version': np.__version__,
+    })
+
+    # writes to a temporary directory first so that other processes never load a partial table
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    for k, v in arrays.items():
+        np.save(os.path.join(tmp_path, f'{k}.npy'), np.asarray(v))
+    with open(os.path.join(tmp_path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:  # another process has just saved the same table
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+# loads a table if it has been made, otherwise builds it with build() (which returns a dictionary of arrays) and saves it
+def cached_table(cache_dir, spec, build, rebuild=False):
+
+    if not rebuild:
+        arrays = load_table(cache_dir, spec)
+        if arrays is not None:
+            return arrays
+
+    print(f"Building {spec['table']} EOS table...")
+    start = time.time()
+    arrays = build()
+    metadata = {'build_seconds': time.time() - start}
+
+    # summary of any error maps, so that the accuracy of tables of different resolutions can be compared
+    for k, v in arrays.items():
+        if k.endswith('error'):
+            finite = np.asarray(v)[np.isfinite(v)]
+            metadata[f'{k}_summary'] = {'max': float(np.max(finite, initial=0)),
+                                        'median': float(np.median(finite)) if finite.size > 0 else None,
+                                        'non_finite': int(np.size(v) - finite.size)}
+
+    save_table(cache_dir, spec, arrays, metadata=metadata)
+
+    return load_table(cache_dir, spec)
@@ -0,0 +1,114 @@
+# fast bilinear interpolation on the 2D grids used by the EOS tables
+# the cell index along uniform axes is calculated directly instead of searched for,
+# the two coordinates are passed as separate arrays and the result can be written into an existing array
+#
+# the tables and weights can be stored in single precision (dtype=np.float32), which halves the memory read and written
+# by the interpolation; cells are always located in double precision, so only the values and the weights are rounded
+# and inside the grid |f32 - f64| <= 8 * eps32 * (largest corner value of the cell) ~ 5e-7 times the local table values
+
+import numpy as np
+
+
+# one axis of an interpolation grid
+class grid_axis:
+
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype=float)
+        self.n = len(self.points)
+        self.steps = np.diff(self.points)
+        self.uniform = np.allclose(self.steps, self.steps[0], rtol=1e-9, atol=0)
+        self.start, self.step = self.points[0], self.steps[0]
+
+    # returns the index of the cell containing each value and the fractional position within the cell
+    # values outside the axis are put in the edge cells, so their fractional position is < 0 or > 1
+    def locate(self, x):
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+
+        # NaNs are treated as 0 as in the scipy interpolators (via np.nan_to_num)
+        if not np.all(np.isfinite(x)):
+            x = np.nan_to_num(x)
+
+        if self.uniform:
+            t = x - self.start
+            t /= self.step
+            i = np.floor(t)
+            np.clip(i, 0, self.n - 2, out=i)
+            t -= i
+            return i.astype(np.intp), t
+
+        i = np.searchsorted(self.points, x, side='right') - 1
+        np.clip(i, 0, self.n - 2, out=i)
+        t = x - self.points[i]
+        t /= self.steps[i]
+        return i, t
+
+
+# a 2D grid shared by any number of tables
+# the cell and weights of a set of points are found once with cell() and reused for each table
+class bilinear_grid:
+
+    def __init__(self, x_points, y_points, dtype=float):
+        self.x_axis, self.y_axis = grid_axis(x_points), grid_axis(y_points)
+        self.shape = (self.x_axis.n, self.y_axis.n)
+        self.dtype = np.dtype(dtype)
+
+    # returns the flat table index of the lower corner of the cell of each point and the weights along each axis
+    def cell(self, x, y):
+        i, tx = self.x_axis.locate(x)
+        j, ty = self.y_axis.locate(y)
+        i *= self.y_axis.n
+        if i.shape == np.broadcast_shapes(i.shape, j.shape):
+            i += j
+        else:
+            i = i + j
+        return i, tx.astype(self.dtype, copy=False), ty.astype(self.dtype, copy=False)
+
+
+# bilinear interpolator of a table of values with shape (len(x_points), len(y_points))
+# fill_value=None linearly extrapolates outside the grid (like the scipy interpolators with fill_value=None)
+# the values are stored with the dtype of the grid
+class grid_interpolator:
+
+    def __init__(self, x_points, y_points, values, fill_value=None, grid=None, dtype=float):
+        self.grid = bilinear_grid(x_points, y_points, dtype=dtype) if grid is None else grid
+        values = np.asarray(values)
+        assert values.shape == self.grid.shape
+        self.values = np.ascontiguousarray(values, dtype=self.grid.dtype).ravel()
+        self.fill_value = fill_value
+
+    def __call__(self, x, y, out=None):
+        return self.at(self.grid.cell(x, y), out=out)
+
+    # interpolates at a cell already found with grid.cell()
+    def at(self, cell, out=None):
+        k, tx, ty = cell
+        values, ny = self.values, self.grid.y_axis.n
+
+        # interpolates along x on the lower and upper y edges of the cell, then along y
+        # the shifted views of the flat table give the other corners of the cell without any index arithmetic
+        lower = np.take(values, k)
+        upper = np.take(values[ny:], k)
+        upper -= lower
+        upper *= tx
+        lower += upper
+
+        np.take(values[1:], k, out=upper)
+        corner = np.take(values[ny + 1:], k)
+        corner -= upper
+        corner *= tx
+        upper += corner
+
+        upper -= lower
+        upper *= ty
+        out = np.add(lower, upper, out=out)
+
+        if self.fill_value is not None:
+            outside = (tx < 0) | (tx > 1) | (ty < 0) | (ty > 1)
+            out[outside] = self.fill_value
+
+        return out
+
+    # value at the table point nearest to each point, for a cell already found with grid.cell() (e.g. for flags)
+    def nearest(self, cell):
+        k, tx, ty = cell
+        return np.take(self.values, k + (tx > 0.5) * self.grid.y_axis.n + (ty > 0.5))
@@ -0,0 +1,76 @@
+# bounded least recently used cache of EOS function results, for repeated calls with the same input arrays
+# arrays are identified by a cheap fingerprint: their id, memory address, shape, dtype and a hash of a sample of their
+# values, so a new array (or one that has been changed at any of the sampled points) is a miss
+# changing an array in place at points that are not sampled is not detected, so the cache is opt-in
+
+from collections import OrderedDict
+import numpy as np
+
+# number of values of each array that are hashed
+sample_size = 1024
+
+
+# fingerprint of an argument of an EOS function
+def fingerprint(x):
+    if isinstance(x, np.ndarray):
+        step = max(1, x.size // sample_size)
+        sample = np.ascontiguousarray(x.flat[::step])
+        return 'array', id(x), x.__array_interface__['data'][0], x.shape, x.dtype.str, hash(sample.tobytes())
+
+    # lists and tuples (e.g. fields=['P', 'S']) by their contents, so that a new list with the same id is not a hit
+    if isinstance(x, (list, tuple)):
+        return 'sequence', type(x).__name__, tuple(fingerprint(v) for v in x)
+
+    try:
+        hash(x)
+        return 'value', type(x).__name__, x
+    except TypeError:
+        return 'object', id(x)
+
+
+# copies the arrays of a result so that the cached result can not be changed by the caller
+def copy_result(result):
+    if isinstance(result, dict):
+        return {k: np.copy(v) for k, v in result.items()}
+    return np.copy(result)
+
+
+class memo_cache:
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self.function_hits, self.function_misses = {}, {}
+
+    # returns the cached result of name(*args, **kwargs) if there is one, otherwise calls f() and caches the result
+    def __call__(self, name, f, args, kwargs):
+        key = (name, tuple(fingerprint(a) for a in args),
+               tuple((k, fingerprint(v)) for k, v in sorted(kwargs.items())))
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.function_hits[name] = self.function_hits.get(name, 0) + 1
+            return copy_result(self.entries[key][2])
+
+        self.misses += 1
+        self.function_misses[name] = self.function_misses.get(name, 0) + 1
+        result = f()
+
+        # the arguments are kept with the result so that their ids can not be reused by new objects while cached
+        self.entries[key] = (args, kwargs, copy_result(result))
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return result
+
+    def clear(self):
+        self.entries.clear()
+
+    # number of hits and misses, in total and for each function
+    def stats(self):
+        names = sorted(set(self.function_hits) | set(self.function_misses))
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'max_size': self.max_size,
+                'functions': {k: {'hits': self.function_hits.get(k, 0), 'misses': self.function_misses.get(k, 0)}
+                              for k in names}}
@@ -3,6 +3,9 @@
 ### STS 09/2019
 ###
 ##
+import os
+import shutil
+import hashlib
 import numpy as np
 #
 #
@@ -127,6 +130,35 @@ class EOSaneoshugoniot:
         self.up  = 0
         self.units = ''
 #
+def readsesame301(fname, nvars):
+    """Function for reading the 301 table of a SESAME-STYLE EOS file into a flat array.
+
+    nvars is the number of variables at each T,rho point (3 for the STD table, 4 for the EXT table).
+    The table is parsed in one vectorised pass instead of splitting every line separately.
+    """
+    nskip = 6 # skip standard header to get to the content of the 301 table
+    sesamefile = open(fname,"r")
+    sesamedata = sesamefile.read().split('\n', nskip)[nskip]
+    sesamefile.close()
+    # num.density, num. temps
+    dlen = float(sesamedata[0:16])
+    tlen = float(sesamedata[16:32])
+    nwords = int(dlen*tlen*nvars+dlen+tlen+2.0)
+    neos = int(np.ceil(nwords/5.0))
+    # only parse the lines belonging to the 301 table
+    lines = sesamedata.split('\n', neos)[0:neos]
+    data = np.fromstring(' '.join(lines), dtype=float, sep=' ')
+    # pad the last line with zeros as in the line by line reader
+    return np.concatenate((data, np.zeros(neos*5-data.size)))
+#
+def sesamecachekey(fnames):
+    """Function for making the binary cache key from the names, sizes and modification times of the source files."""
+    key = hashlib.sha1()
+    for fname in fnames:
+        stat = os.stat(fname)
+        key.update('{} {:d} {:d}\n'.format(os.path.basename(fname), stat.st_size, stat.st_mtime_ns).encode())
+    return key.hexdigest()
+#
 class extEOStable:
     """Class for accessing EXTENDED SESAME-STYLE EOS tables output from ANEOS"""
     #     ANEOS KPA FLAG
@@ -188,33 +220,7 @@ class extEOStable:
             self.units = 'Units: rho g/cm3, T K, P GPa, U MJ/kg, A MJ/kg, S MJ/K/kg, cs cm/s, cv MJ/K/kg, KPA flag. 2D arrays are (NT,ND).'
         else:
             self.units = unitstxt
-        sesamefile = open(fname,"r")  
-        sesamedata=sesamefile.readlines()
-        sesamefile.close()
-        nskip = 6 # skip standard header to get to the content of the 301 table
-        # num.density, num. temps
-        tmp = sesamedata[nskip][0:16]
-        dlen = float(tmp)
-        tmp = sesamedata[nskip][16:32]
-        tlen = float(tmp)
-        if (np.mod((dlen*tlen*3.0+dlen+tlen+2.0),5.0) == 0):
-            neos = int((dlen*tlen*3.0+dlen+tlen+2.0)/5.0) 
-        else:
-            neos = int((dlen*tlen*3.0+dlen+tlen+2.0)/5.0) +1
-        #print(dlen,tlen,neos,len(sesamedata))
-        data = np.zeros((neos,5),dtype=float)
-        for j in range(nskip,neos+nskip):
-            tmp3 = sesamedata[j]
-            tmp4 = list(tmp3.split())
-            if len(tmp4) < 5:
-                lentmp4 = len(tmp4)
-                data[j-nskip,0:lentmp4] = np.asarray(tmp4[0:lentmp4])
-            else:
-                data[j-nskip,:] = np.asarray(tmp4)
-            #print(j,eosarr[j,:])
-        #print(data.shape)
-        data=np.resize(data,(neos*5))
-        #print(data.shape)
+        data = readsesame301(fname, nvars=3) # flat array of the 301 table, 3 variables at each T,rho point
         self.ND  = data[0].astype(int)  # now fill the extEOStable class
         self.NT  = data[1].astype(int)
         self.rho = data[2:2+self.ND]
@@ -247,33 +253,7 @@ class extEOStable:
             self.units = 'Units: rho g/cm3, T K, P GPa, U MJ/kg, A MJ/kg, S MJ/K/kg, cs cm/s, cv MJ/K/kg, KPA flag. 2D arrays are (NT,ND).'
         else:
             self.units = unitstxt
-        sesamefile = open(fname,"r")  
-        sesamedata=sesamefile.readlines()
-        sesamefile.close()
-        nskip = 6 # skip standard header to get to the content of the 301 table
-        # num.density, num. temps
-        tmp = sesamedata[nskip][0:16]
-        dlen = float(tmp)
-        tmp = sesamedata[nskip][16:32]
-        tlen = float(tmp)
-        if (np.mod((dlen*tlen*4.0+dlen+tlen+2.0),5.0) == 0):
-            neos = int((dlen*tlen*4.0+dlen+tlen+2.0)/5.0)
-        else:
-            neos = int((dlen*tlen*4.0+dlen+tlen+2.0)/5.0) +1
-        #print(dlen,tlen,neos,len(sesamedata))
-        data = np.zeros((neos,5),dtype=float)
-        for j in range(nskip,neos+nskip):
-            tmp3 = sesamedata[j]
-            tmp4 = list(tmp3.split())
-            if len(tmp4) < 5:
-                lentmp4 = len(tmp4)
-                data[j-nskip,0:lentmp4] = np.asarray(tmp4[0:lentmp4])
-            else:
-                data[j-nskip,:] = np.asarray(tmp4)        
-            #print(j,eosarr[j,:])
-        #print(data.shape)
-        data=np.resize(data,(neos*5))
-        #print(data.shape)
+        data = readsesame301(fname, nvars=4) # flat array of the 301 table, 4 variables at each T,rho point
         self.ND  = data[0].astype(int)  # now fill the extEOStable class
         self.NT  = data[1].astype(int)
         self.rho = data[2:2+self.ND]
@@ -298,6 +278,59 @@ class extEOStable:
         self.KPA = data[2+self.ND+self.NT+3*self.ND*self.NT
                             : 2+self.ND+self.NT+4*self.ND*self.NT
                             ].reshape(self.NT,self.ND)
+#
+    # variables saved in the binary cache, the sub-structures are filled by loadaneos
+    cachevars = ['ND', 'NT', 'rho', 'T', 'P', 'U', 'A', 'S', 'cs', 'cv', 'KPA', 'units',
+                 'gamma0', 'theta0', 'C24', 'C60', 'C61', 'beta']
+    cachestructs = ['vc', 'mc', 'cp', 'tp', 'onebar', 'anhug']
+
+    def savecache(self, cachedir):
+        """Function for saving the loaded EOS table as a directory of binary .npy files."""
+        # write to a temporary directory first so that other processes never see a partial cache
+        tmpdir = cachedir+'.tmp{}'.format(os.getpid())
+        os.makedirs(tmpdir, exist_ok=True)
+        for var in self.cachevars:
+            np.save(os.path.join(tmpdir, var+'.npy'), np.asarray(getattr(self, var)))
+        for struct in self.cachestructs:
+            for var, val in vars(getattr(self, struct)).items():
+                np.save(os.path.join(tmpdir, struct+'.'+var+'.npy'), np.asarray(val))
+        try:
+            os.rename(tmpdir, cachedir)
+        except OSError: # another process has already written this cache
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def loadcache(self, cachedir, mmap_mode='r'):
+        """Function for loading an EOS table saved by savecache. Arrays are memory-mapped by default."""
+        for fname in os.listdir(cachedir):
+            val = np.load(os.path.join(cachedir, fname), mmap_mode=mmap_mode)
+            if val.ndim == 0:
+                val = val[()].item()
+            names = fname[:-len('.npy')].split('.')
+            if len(names) == 1:
+                setattr(self, names[0], val)
+            else:
+                setattr(getattr(self, names[0]), names[1], val)
+
+    def loadall(self, stdfname, extfname, aneosinfname, aneosoutfname, cachedir=None, silent=True):
+        """Function for loading the STD and EXT SESAME files and the ANEOS files, using a binary cache when possible.
+
+        The cache is stored in cachedir under a key made from the source files, and is only used when it is
+        newer than all of the source files. The SESAME header variables must be set before calling this function.
+        """
+        fnames = [stdfname, extfname, aneosinfname, aneosoutfname]
+        if cachedir is not None:
+            keydir = os.path.join(cachedir, sesamecachekey(fnames))
+            if os.path.isdir(keydir) and os.path.getmtime(keydir) > max(os.path.getmtime(f) for f in fnames):
+                if silent == False:
+                    print('Loading EOS from binary cache ',keydir)
+                self.loadcache(keydir)
+                return
+        self.loadextsesame(extfname)
+        self.loadstdsesame(stdfname)
+        self.loadaneos(aneosinfname=aneosinfname, aneosoutfname=aneosoutfname, silent=silent)
+        if cachedir is not None:
+            os.makedirs(cachedir, exist_ok=True)
+            self.savecache(keydir)
 #
     def view(self, q='P', Tlow=None, Thigh=None, rholow=None, rhohigh=None):
         """Function for printing values from EXTENDED SESAME-STYLE EOS table."""
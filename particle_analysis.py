@@ -0,0 +1,341 @@
+# analysis of particle data held in plain numpy arrays (or h5py datasets), independent of the snapshot readers
+# used by snapshot_analysis for the centre of mass, the radial mass profiles and the spatial index of the particles,
+# the sidecar caches of the arrays derived from each snapshot and the registry of the derived particle fields
+
+import hashlib
+import os
+from contextlib import contextmanager
+from functools import cached_property
+import numpy as np
+from scipy.spatial import cKDTree
+
+import EOS_cache
+
+# number of particles read at a time when reducing over all the particles
+chunk_size = 2 ** 20
+
+
+# sums of the weights and weighted positions of the particles within radius of center (all particles if radius is None)
+# pos and weights can be numpy arrays or h5py datasets, which are read chunk_size particles at a time
+# if keep is True the positions and weights of the particles within the radius are also returned
+def weighted_position_sums(pos, weights, center=None, radius=None, keep=False):
+    weight_sum, pos_sum, count = 0, np.zeros(3), 0
+    kept_pos, kept_weights = [], []
+
+    for start in range(0, pos.shape[0], chunk_size):
+        p = np.asarray(pos[start:start + chunk_size], dtype=float)
+        w = np.asarray(weights[start:start + chunk_size], dtype=float)
+
+        if radius is not None:
+            d = p - center
+            inside = np.einsum('ij,ij->i', d, d) < radius ** 2
+            p, w = p[inside], w[inside]
+
+        weight_sum += np.sum(w)
+        pos_sum += w @ p
+        count += len(w)
+
+        if keep:
+            kept_pos.append(p)
+            kept_weights.append(w)
+
+    kept = (np.concatenate(kept_pos), np.concatenate(kept_weights)) if keep else None
+    return weight_sum, pos_sum, count, kept
+
+
+# largest distance of a particle from center
+def max_distance(pos, center):
+    distance = 0
+    for start in range(0, pos.shape[0], chunk_size):
+        d = np.asarray(pos[start:start + chunk_size], dtype=float) - center
+        distance = max(distance, np.sqrt(np.max(np.einsum('ij,ij->i', d, d), initial=0)))
+    return distance
+
+
+# centre of mass of a set of particles, with the positions weighted by mass or density
+# or found with the shrinking sphere method (Power et al. 2003), which repeatedly shrinks a sphere by shrink_factor around
+# the centre of mass of the particles inside it until fewer than min_particles are left, giving the centre of the
+# densest part of the particles (the bound remnant) without the ejecta pulling it away
+# pos, masses and densities can be numpy arrays or h5py datasets (see weighted_position_sums)
+def particle_center_of_mass(pos, masses, densities=None, weighting='mass', shrink_factor=0.9, min_particles=1000):
+
+    if weighting == 'density':
+        weight_sum, pos_sum, _, _ = weighted_position_sums(pos, densities)
+        return pos_sum / weight_sum
+    elif weighting not in ('mass', 'shrinking_sphere'):
+        raise ValueError(f'Unknown centre of mass weighting {weighting}')
+
+    weight_sum, pos_sum, count, _ = weighted_position_sums(pos, masses)
+    center = pos_sum / weight_sum
+    if weighting == 'mass':
+        return center
+
+    radius = max_distance(pos, center)
+    while count > min_particles:
+        radius *= shrink_factor
+
+        # once the particles in the sphere fit in memory only they are searched in the next iterations
+        keep = isinstance(pos, np.ndarray) or count <= chunk_size
+        weight_sum, pos_sum, count_inside, inside = weighted_position_sums(pos, masses, center, radius, keep=keep)
+        if count_inside < min_particles:
+            break
+
+        center, count = pos_sum / weight_sum, count_inside
+        if keep:
+            pos, masses = inside
+
+    return center
+
+
+# particles sorted by radius with their cumulative mass, so that the mass within any radius is found with a binary search
+# radii and masses are plain arrays (in m and kg for the snapshot indexes)
+class radial_mass_index:
+
+    def __init__(self, radii, masses):
+        order = np.argsort(radii, kind='stable')
+        self.radii = np.asarray(radii)[order]
+        self.cumulative_mass = np.concatenate(([0], np.cumsum(np.asarray(masses, dtype=float)[order])))
+
+    # total mass of the particles with a radius < r
+    def mass_within(self, r):
+        return self.cumulative_mass[np.searchsorted(self.radii, r, side='left')]
+
+    # radius of the particle at which the cumulative mass reaches the given mass (inf if the particles have less mass)
+    def radius_enclosing(self, mass):
+        i = np.searchsorted(self.cumulative_mass, mass, side='left')
+        return np.concatenate(([0], self.radii, [np.inf]))[i]
+
+
+# number of particles in the leaves of the particle index
+index_leafsize = 64
+
+
+# kd-tree over the particle positions that answers region queries by only visiting the parts of the tree overlapping
+# the region, the nodes are stored as flat arrays (see particle_index_arrays) and are walked one level at a time for all
+# of the nodes of the level at once, so the index can be saved as .npy files and memory-mapped
+# positions are plain arrays (relative to the centre of mass in Rearth for the snapshot index)
+# queries return the sorted indexes of the particles in the region, including particles on its boundary
+class particle_index:
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.pos, self.order = arrays['pos'], arrays['order']
+        self.node_start, self.node_end = arrays['node_start'], arrays['node_end']
+        self.node_lesser, self.node_greater = arrays['node_lesser'], arrays['node_greater']
+        self.node_lower, self.node_upper = arrays['node_lower'], arrays['node_upper']
+        self.z_order, self.z_sorted = arrays['z_order'], arrays['z_sorted']
+
+    # walks the tree, overlaps(lower, upper) and contains(lower, upper) say which node bounds may contain particles in
+    # the region and only contain particles in the region, and inside(pos) which particles are in the region
+    def search(self, overlaps, contains, inside):
+        nodes = np.zeros(1, dtype=np.intp)
+        whole, partial = [], []
+
+        while nodes.size > 0:
+            nodes = nodes[overlaps(self.node_lower[nodes], self.node_upper[nodes])]
+            contained = contains(self.node_lower[nodes], self.node_upper[nodes])
+            whole.append(nodes[contained])
+
+            nodes = nodes[~contained]
+            leaf = self.node_lesser[nodes] < 0
+            partial.append(nodes[leaf])
+            nodes = np.concatenate((self.node_lesser[nodes[~leaf]], self.node_greater[nodes[~leaf]]))
+
+        whole, partial = np.concatenate(whole), np.concatenate(partial)
+        j = node_points(self.node_start[partial], self.node_end[partial])
+        j = np.concatenate((node_points(self.node_start[whole], self.node_end[whole]), j[inside(self.pos[j])]))
+        return np.sort(self.order[j])
+
+    # particles within radius of center
+    def ball(self, radius, center=(0, 0, 0)):
+        return self.shell(0, radius, center)
+
+    # particles in the box between lower and upper (which can be infinite)
+    def box(self, lower, upper):
+        box_lower, box_upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+        return self.search(lambda lower, upper: np.all((lower <= box_upper) & (upper >= box_lower), axis=1),
+                           lambda lower, upper: np.all((lower >= box_lower) & (upper <= box_upper), axis=1),
+                           lambda p: np.all((p >= box_lower) & (p <= box_upper), axis=1))
+
+    # particles in the spherical shell r_min <= r <= r_max around center
+    def shell(self, r_min, r_max, center=(0, 0, 0)):
+        center = np.asarray(center, dtype=float)
+        distance = lambda p: np.sum((p - center) ** 2, axis=1)
+        nearest = lambda lower, upper: np.sum(np.maximum(np.maximum(lower - center, center - upper), 0) ** 2, axis=1)
+        furthest = lambda lower, upper: np.sum(np.maximum(np.abs(lower - center), np.abs(upper - center)) ** 2, axis=1)
+        return self.search(
+            lambda lower, upper: (nearest(lower, upper) <= r_max ** 2) & (furthest(lower, upper) >= r_min ** 2),
+            lambda lower, upper: (furthest(lower, upper) <= r_max ** 2) & (nearest(lower, upper) >= r_min ** 2),
+            lambda p: (distance(p) >= r_min ** 2) & (distance(p) <= r_max ** 2))
+
+    # particles in the horizontal slab z_min <= z <= z_max, found with a binary search of the particles sorted by z
+    def slab(self, z_min, z_max):
+        first = np.searchsorted(self.z_sorted, z_min, side='left')
+        last = np.searchsorted(self.z_sorted, z_max, side='right')
+        return np.sort(self.z_order[first:last])
+
+    # particles in the annulus R_min <= R_xy <= R_max around the z axis with |z| <= z_max
+    def annulus(self, R_min, R_max, z_max=np.inf):
+        nearest = lambda lower, upper: np.sum(np.maximum(np.maximum(lower[:, :2], -upper[:, :2]), 0) ** 2, axis=1)
+        furthest = lambda lower, upper: np.sum(np.maximum(np.abs(lower[:, :2]), np.abs(upper[:, :2])) ** 2, axis=1)
+        return self.search(
+            lambda lower, upper: (nearest(lower, upper) <= R_max ** 2) & (furthest(lower, upper) >= R_min ** 2) &
+                                 (lower[:, 2] <= z_max) & (upper[:, 2] >= -z_max),
+            lambda lower, upper: (furthest(lower, upper) <= R_max ** 2) & (nearest(lower, upper) >= R_min ** 2) &
+                                 (lower[:, 2] >= -z_max) & (upper[:, 2] <= z_max),
+            lambda p: (np.sum(p[:, :2] ** 2, axis=1) >= R_min ** 2) & (np.sum(p[:, :2] ** 2, axis=1) <= R_max ** 2) &
+                      (np.abs(p[:, 2]) <= z_max))
+
+    # cKDTree of the positions for nearest neighbour queries, built when first used
+    @cached_property
+    def tree(self):
+        return cKDTree(self.pos)
+
+    # distances to and indexes of the k nearest particles of each point (e.g. for smoothing lengths or clump finding)
+    def nearest(self, points, k=1):
+        distances, j = self.tree.query(points, k)
+        return distances, self.order[np.minimum(j, len(self.order) - 1)]
+
+
+# positions in the tree order of all of the particles of a set of nodes, each of which covers start to end
+def node_points(start, end):
+    lengths = end - start
+    offsets = np.repeat(start - (np.cumsum(lengths) - lengths), lengths)
+    return offsets + np.arange(np.sum(lengths))
+
+
+# builds the arrays of a particle_index, the tree is split with scipy's cKDTree and its nodes are flattened into arrays
+# of their particle ranges (in the tree order), children (-1 for leaves) and bounds, in breadth first order
+def particle_index_arrays(pos, leafsize=index_leafsize):
+    pos = np.ascontiguousarray(pos, dtype=float)
+    tree = cKDTree(pos, leafsize=leafsize)
+
+    start, end, lesser, greater, lower, upper = [], [], [], [], [], []
+    queue, k = [(tree.tree, tree.mins.tolist(), tree.maxes.tolist())], 0
+    while k < len(queue):
+        node, node_lower, node_upper = queue[k]
+        queue[k] = None
+        k += 1
+
+        start.append(node.start_idx)
+        end.append(node.end_idx)
+        lower.append(node_lower)
+        upper.append(node_upper)
+
+        if node.split_dim < 0:
+            lesser.append(-1)
+            greater.append(-1)
+            continue
+
+        # the split bounds the children along the split dimension
+        lesser_upper, greater_lower = list(node_upper), list(node_lower)
+        lesser_upper[node.split_dim] = greater_lower[node.split_dim] = node.split
+        lesser.append(len(queue))
+        queue.append((node.lesser, node_lower, lesser_upper))
+        greater.append(len(queue))
+        queue.append((node.greater, greater_lower, node_upper))
+
+    order = np.asarray(tree.indices, dtype=np.intp)
+    z_order = np.argsort(pos[:, 2], kind='stable')
+
+    return {'pos': pos[order], 'order': order,
+            'node_start': np.array(start, dtype=np.intp), 'node_end': np.array(end, dtype=np.intp),
+            'node_lesser': np.array(lesser, dtype=np.intp), 'node_greater': np.array(greater, dtype=np.intp),
+            'node_lower': np.array(lower, dtype=float), 'node_upper': np.array(upper, dtype=float),
+            'z_order': z_order, 'z_sorted': pos[z_order, 2]}
+
+
+# number of bytes read from the start and the end of a snapshot file to identify its contents
+signature_bytes = 2 ** 20
+
+
+# identifies the contents of a file by its size, modification time and a hash of its first and last bytes
+def file_signature(filename):
+    stat = os.stat(filename)
+    file_hash = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        file_hash.update(f.read(signature_bytes))
+        f.seek(max(stat.st_size - signature_bytes, 0))
+        file_hash.update(f.read(signature_bytes))
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash.hexdigest()}
+
+
+# directory next to a snapshot file that the arrays derived from it are cached in (e.g. snapshot_0240_derived/)
+def sidecar_dir(filename):
+    return f'{os.path.splitext(filename)[0]}_derived'
+
+
+# loads arrays derived from a snapshot file (e.g. the particle fields) from its sidecar directory, or builds them with
+# build() (which returns a dictionary of arrays) and saves them there, the analysis continues without the cache if the
+# directory can not be written to
+# the spec must identify the file (see file_signature) and carry the version of the derived arrays, the EOS table
+# cache_version is left out of the key as the arrays do not depend on the EOS tables
+def sidecar_arrays(filename, spec, build, name):
+    cache_dir = sidecar_dir(filename)
+    arrays = EOS_cache.load_table(cache_dir, spec, versioned=False)
+    if arrays is not None:
+        print(f'Loaded {name} from {cache_dir}')
+        return arrays
+
+    print(f'Building {name}...')
+    arrays = build()
+
+    try:
+        EOS_cache.save_table(cache_dir, spec, arrays, versioned=False)
+    except OSError as error:
+        print(f'Unable to cache {name}: {error}')
+
+    return arrays
+
+
+# derived particle fields of a snapshot, each calculated when it is first requested and attached to the swiftsimio gas
+# object (where the slicers read it from), so that only the fields that are used take up memory
+# a name ending in _mass_weighted gives a field (registered or loaded by swiftsimio) multiplied by the particle masses
+class derived_field_registry:
+
+    def __init__(self, gas):
+        self.gas = gas
+        self.functions = {}
+        self.attached = set()
+
+    # registers a function that returns the cosmo_array of a field, replacing any previous version of the field
+    def register(self, name, function):
+        self.release(name, f'{name}_mass_weighted')
+        self.functions[name] = function
+
+    # returns a field, calculating it and attaching it to the gas object if it has not been already
+    def get(self, name):
+        if name not in self.attached:
+            if name in self.functions:
+                value = self.functions[name]()
+            elif name.endswith('_mass_weighted'):
+                value = self.get(name[:-len('_mass_weighted')]) * self.gas.masses
+            else:
+                return getattr(self.gas, name)  # loaded by swiftsimio (AttributeError if there is no such field)
+
+            setattr(self.gas, name, value)
+            self.attached.add(name)
+
+        return getattr(self.gas, name)
+
+    # calculates fields that are read from the gas object directly (e.g. by slice_gas)
+    def require(self, *names):
+        for name in names:
+            self.get(name)
+
+    # removes calculated fields from the gas object to free their memory, they are recalculated if requested again
+    def release(self, *names):
+        for name in names:
+            if name in self.attached:
+                delattr(self.gas, name)
+                self.attached.remove(name)
+
+    # calculates fields for a block of code and releases the fields it calculated afterwards
+    @contextmanager
+    def using(self, *names):
+        attached = set(self.attached)
+        try:
+            self.require(*names)
+            yield
+        finally:
+            self.release(*(self.attached - attached))
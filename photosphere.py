@@ -56,13 +56,18 @@ class photosphere:
 
     # sample size and max size both have units
     def __init__(self, snapshot, sample_size=12*Rearth, max_size=50*Rearth, period=None,
-                 resolution=500, n_theta=100, n_phi=10, droplet_infall=True):
+                 resolution=500, n_theta=100, n_phi=10, droplet_infall=True, multi_material=False):
 
         sample_size.convert_to_units(Rearth)
         max_size.convert_to_units(Rearth)
         self.snapshot = snapshot
         self.data = {}
         self.droplet_infall = droplet_infall
+        self.multi_material = multi_material
+
+        # fails before the snapshot is sliced if any of the materials do not have an EOS
+        if multi_material:
+            fst.check_materials(np.unique(np.array(snapshot.data.gas.material_ids)))
 
         self.j_phot = np.zeros(n_theta+1)
         self.luminosity = 0
@@ -152,16 +157,19 @@ class photosphere:
         print('Loading data into photosphere model:')
 
         # loads multiple sections at different phi angles and averages them
-        self.data = get_section(0)
+        # the mass weighted particle fields are only kept in memory while the sections are loaded
+        sliced_fields = ['temperatures', 'pressures', 'entropy', 'specific_angular_momentum', 'material_ids']
+        with snapshot.fields.using(*[f'{p}_mass_weighted' for p in sliced_fields]):
+            self.data = get_section(0)
 
-        for i in tqdm(range(1, n_phi)):
-            vals = get_section(np.pi / n_phi * i)
-            for k in self.data.keys():
-                self.data[k] = (i * self.data[k] + vals[k]) / (i + 1)
+            for i in tqdm(range(1, n_phi)):
+                vals = get_section(np.pi / n_phi * i)
+                for k in self.data.keys():
+                    self.data[k] = (i * self.data[k] + vals[k]) / (i + 1)
 
         # fixes an error with infinite pressure
         infinite_mask = np.isfinite(self.data['P'])
-        P_fix = fst.P_EOS(self.data['rho'], self.data['T'].value)
+        P_fix = self.EOS('P_EOS', self.data['rho'], self.data['T'].value)
         self.data['P'] = np.where(infinite_mask, self.data['P'], P_fix)
 
         max_size.convert_to_mks()
@@ -205,12 +213,20 @@ class photosphere:
             self.entropy_extrapolation = self.extrapolate_entropy()
             self.hydrostatic_equilibrium(initial_extrapolation=True)
         else:
-            self.data['u'] = fst.u_EOS(self.data['rho'], self.data['T'])
+            self.data['u'] = self.EOS('u_EOS', self.data['rho'], self.data['T'])
 
         self.calculate_EOS()
 
         self.verbose = True
 
+    # evaluates an EOS function (given by name, e.g. 'P_EOS') for every cell of the model
+    # uses the EOS of the material of each cell if multi_material is set, otherwise forsterite everywhere
+    # (the hydrostatic extrapolation always uses forsterite)
+    def EOS(self, name, *args, **kwargs):
+        if self.multi_material:
+            return fst.by_material(name, self.data['matid'], *args, **kwargs)
+        return getattr(fst, name)(*args, **kwargs)
+
     # plots a cross-section of the photosphere as a contour plot for a given parameter
     def plot(self, parameter, log=True, contours=None, cmap='turbo', plot_photosphere=False, round_to=1,
              val_min=None, val_max=None, save=None, xlim=None, ylim=None):
@@ -370,6 +386,9 @@ class photosphere:
             print(u"\u2588", end='')
             return P_solution.T, j_0, i
 
+        # loads the (S, P) tables used by dlnPdr before the pool is forked, so the workers do not each build them
+        fst.forsterite.rho_interp
+
         pool = Pool(cpus - 1)
         results = pool.map(extrapolate, range(self.n_theta))
         print(' DONE')
@@ -378,31 +397,28 @@ class photosphere:
             i, j_0 = r[2], r[1]
             self.data['P'][i:i + 1, j_0:] = r[0]
 
-        self.data['rho'] = fst.rho_EOS(self.data['s'], self.data['P'])
-        self.data['T'] = fst.T1_EOS(self.data['s'], self.data['P'])
-        self.data['u'] = fst.u_EOS(self.data['rho'], self.data['T'])
+        state = self.EOS('state_from_SP', self.data['s'], self.data['P'], fields=('rho', 'T', 'u'))
+        self.data['rho'], self.data['T'], self.data['u'] = state['rho'], state['T'], state['u']
 
     # updates the alpha and other thermodynamic variables (run once rho, T, P, S have been updated)
     def calculate_EOS(self):
 
-        self.data['alpha'] = fst.alpha(self.data['rho'], self.data['T'], self.data['P'], self.data['s'])
-        self.data['alpha_v'] = fst.alpha(self.data['rho'], self.data['T'], self.data['P'], self.data['s'], D0=0)
+        state = self.EOS('phase_state', self.data['rho'], self.data['T'], self.data['P'], self.data['s'])
+        self.data['alpha'], self.data['alpha_v'] = state['alpha'], state['alpha_v']
 
         self.data['m'] = self.data['rho'] * self.data['V']
         self.data['E'] = self.data['u'] * self.data['m']
         self.data['rho_E'] = self.data['E'] / self.data['V']
 
-        self.data['phase'] = fst.phase(self.data['s'], self.data['P'])
-        self.data['vq'] = fst.vapor_quality(self.data['s'], self.data['P'])
-        self.data['lvf'] = fst.liquid_volume_fraction(self.data['rho'], self.data['P'], self.data['s'])
+        self.data['phase'], self.data['vq'], self.data['lvf'] = state['phase'], state['vq'], state['lvf']
 
     # removes droplets that have condensed
     def remove_droplets(self, max_infall=1e4, check_infall=True, check_alpha=False, dt=1):
 
         condensation_mask = self.data['phase'] == 2
 
-        rho_drop = fst.rho_liquid(self.data['P'])
-        rho_vapour = fst.rho_vapor(self.data['rho'], self.data['s'], self.data['P'])
+        rho_drop = self.EOS('rho_liquid', self.data['P'])
+        rho_vapour = self.EOS('rho_vapor', self.data['rho'], self.data['s'], self.data['P'])
         D0, CD = 1e-3, 0.5
         keplerian_omega = np.sqrt((6.674e-11 * self.central_mass) / (self.data['R'] ** 3))
         omega = self.snapshot.best_fit_rotation_curve_mks(self.data['R'])
@@ -420,11 +436,12 @@ class photosphere:
 
         initial_mass = np.array(self.data['m'])
         total_initial_mass = np.nansum(initial_mass[remove_mask])
-        new_S = fst.condensation_S(self.data['s'], self.data['P'])
+        new_S = self.EOS('condensation_S', self.data['s'], self.data['P'])
         self.data['s'] = np.where(remove_mask, new_S, self.data['s'])
-        self.data['rho'] = fst.rho_EOS(self.data['s'], self.data['P'])
-        self.data['T'] = np.nan_to_num(fst.T1_EOS(self.data['s'], self.data['P']))
-        self.data['u'] = fst.u_EOS(self.data['rho'], self.data['T'])
+        state = self.EOS('state_from_SP', self.data['s'], self.data['P'], fields=('rho', 'T', 'u'))
+        self.data['rho'] = state['rho']
+        self.data['T'] = np.nan_to_num(state['T'])
+        self.data['u'] = state['u']
         self.calculate_EOS()
 
         final_mass = self.data['m']
@@ -511,12 +528,13 @@ class photosphere:
         k = np.minimum(max_time / t_cool, 0.5)
         du = k * u1
         u2 = u1 - du
-        T2 = fst.T2_EOS(u2, rho)
+        T2 = self.EOS('T2_EOS', u2, rho)
 
+        state = self.EOS('state_from_rhoT', rho, T2, fields=('P', 'S'))
         self.data['u'] = u2
         self.data['T'] = T2
-        self.data['P'] = fst.P_EOS(rho, T2)
-        self.data['s'] = fst.S_EOS(rho, T2)
+        self.data['P'] = state['P']
+        self.data['s'] = state['S']
         self.calculate_EOS()
 
         return True
@@ -544,9 +562,10 @@ class photosphere:
         assert k <= 1
 
         self.data['u'] = u2
-        self.data['T'] = np.nan_to_num(fst.T2_EOS(self.data['u'], self.data['rho']))
-        self.data['P'] = fst.P_EOS(self.data['rho'], self.data['T'])
-        self.data['S'] = fst.S_EOS(self.data['rho'], self.data['T'])
+        self.data['T'] = np.nan_to_num(self.EOS('T2_EOS', self.data['u'], self.data['rho']))
+        state = self.EOS('state_from_rhoT', self.data['rho'], self.data['T'], fields=('P', 'S'))
+        self.data['P'] = state['P']
+        self.data['S'] = state['S']
         self.calculate_EOS()
         self.get_photosphere()
 
@@ -1,7 +1,9 @@
 # reads snapshots of SWIFT simulations for plotting and analysis
 # handles the data on the particle level
 
+import os
 import swiftsimio as sw
+import h5py
 from matplotlib.colors import LogNorm, SymLogNorm
 from swiftsimio.visualisation.slice import slice_gas
 from swiftsimio.visualisation.rotation import rotation_matrix_from_vector
@@ -11,10 +13,14 @@ import unyt
 unyt.define_unit("M_earth", 5.9722e24 * unyt.kg)
 M_earth = unyt.M_earth
 
+from functools import cached_property
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 
+from particle_analysis import particle_center_of_mass, radial_mass_index, particle_index, particle_index_arrays, \
+    index_leafsize, file_signature, sidecar_arrays, derived_field_registry
+
 # data lables used in plots
 data_labels = {
     "z": "z ($R_{\oplus}$)",
@@ -69,17 +75,72 @@ colormaps = {
 }
 
 
+# centre of mass of the gas particles in a SWIFT snapshot, read from the file in chunks without loading the snapshot
+# the position is in the units of the snapshot
+def snapshot_center_of_mass(filename, weighting='mass', **kwargs):
+    with h5py.File(filename, 'r') as file:
+        gas = file['PartType0']
+        return particle_center_of_mass(gas['Coordinates'], gas['Masses'], gas['Densities'],
+                                       weighting=weighting, **kwargs)
+
+
+# swiftsimio mask that only reads the top-level cells of a snapshot that overlap a region around center
+# size is the radius of a sphere (which loads the cells overlapping its bounding box) or the half-widths of a box
+# center is in box coordinates, by default the centre of mass of the whole snapshot (see snapshot_center_of_mass)
+# size and center are in Rearth if they do not have units
+# returns the mask and the [min, max] bounds of the region along each axis in Rearth
+def region_mask(filename, size, center=None, weighting='mass'):
+    mask = sw.mask(filename)
+
+    if center is None:
+        center = snapshot_center_of_mass(filename, weighting=weighting) * mask.units.length
+    center = np.array(center.to(Rearth)) if hasattr(center, 'units') else np.array(center, dtype=float)
+    size = np.array(size.to(Rearth)) if hasattr(size, 'units') else np.array(size, dtype=float)
+
+    box_size = np.array(mask.metadata.boxsize.to(Rearth))
+    lower = np.clip(center - size, 0, box_size)
+    upper = np.clip(center + size, 0, box_size)
+    bounds = [[float(lower[i]), float(upper[i])] for i in range(3)]
+
+    mask.constrain_spatial([[b[0] * Rearth, b[1] * Rearth] for b in bounds])
+    return mask, bounds
+
+
+# increase this if the way the derived particle fields are calculated changes, so that old sidecars are not reloaded
+derived_fields_version = 1
+
+
 # class that stores and analyses particle data in a SWIFT snapshot
 class snapshot:
 
     # note: plot rotation will plot a scatter plot of the particle angular velocity
-    def __init__(self, filename, plot_rotation=False):
+    # com_weighting is the weighting used to find the centre of mass (see particle_center_of_mass)
+    # cache_fields saves the derived particle fields next to the snapshot file, and loads them on later runs
+    # load_region only loads the particles in the cells overlapping a region around load_center (e.g. the remnant and
+    # its disk, leaving out distant ejecta), see region_mask for the arguments
+    def __init__(self, filename, plot_rotation=False, com_weighting='density', cache_fields=True,
+                 load_region=None, load_center=None):
 
         # loads particle data
-        self.data = sw.load(filename)
+        self.filename = filename
+        self.cache_fields = cache_fields
+
+        if load_region is None:
+            self.data = sw.load(filename)
+            self.region_bounds = None
+        else:
+            mask, self.region_bounds = region_mask(filename, load_region, load_center, weighting=com_weighting)
+            self.data = sw.load(filename, mask=mask)
+
+        self.fields = derived_field_registry(self.data.gas)
         print(f'Loaded {len(self.data.gas.densities)} particles')
 
+        self.n_skipped = int(self.data.metadata.n_gas) - len(self.data.gas.densities)
+        if load_region is not None:
+            print(f'Skipped {self.n_skipped} particles outside the region {self.region_bounds} (Rearth)')
+
         self.box_size = self.data.gas.metadata.boxsize
+        self.com_weighting = com_weighting
         self.center_of_mass = self.get_center_of_mass()
 
         self.data.gas.masses.convert_to_mks()
@@ -99,16 +160,40 @@ class snapshot:
         self.z = pos[:, 2] * Rearth
         self.r = np.hypot(np.hypot(pos[:, 0], pos[:, 1]), pos[:, 2]) * Rearth
 
-        self.calculate_EOS()
-        self.calculate_velocities()
+        fields = self.derived_fields()
+        self.calculate_EOS(fields)
+        self.calculate_velocities(fields)
 
         self.HD_limit_R, self.HD_limit_z = self.particle_density_analysis()
         self.HD_limit_R.convert_to_mks()
         self.HD_limit_z.convert_to_mks()
         self.best_fit_rotation_curve_mks, self.CoRoL = self.rotational_analysis(plot_rotation)
 
-    # calculates the EOS for all particles
-    def calculate_EOS(self):
+    # spec identifying the derived particle fields of the snapshot in its sidecar cache
+    def derived_fields_spec(self):
+        return {
+            'table': 'particle_fields',
+            'snapshot': os.path.basename(self.filename),
+            'signature': file_signature(self.filename),
+            'center_of_mass': [float(x) for x in np.array(self.center_of_mass.to(Rearth))],
+            'region_bounds': self.region_bounds,
+            'woma_version': getattr(woma, '__version__', None),
+            'version': derived_fields_version,
+        }
+
+    # per-particle fields derived from the snapshot (in MKS units), T, P and s from the EOS and h, omega, v_r and v_z
+    # loaded from the sidecar cache of the snapshot (memory-mapped) if they have been saved before
+    def derived_fields(self):
+        build = lambda: {**self.EOS_fields(), **self.velocity_fields()}
+
+        if not self.cache_fields:
+            return build()
+
+        return sidecar_arrays(self.filename, self.derived_fields_spec(), build, 'derived particle fields')
+
+    # temperature, pressure and entropy of the particles from the woma EOS
+    # returns no fields if woma does not have the EOS of a material
+    def EOS_fields(self):
         print('Applying EOS to particles...')
 
         gas = self.data.gas
@@ -119,96 +204,100 @@ class snapshot:
         u, rho, mat_id = np.array(gas.internal_energies), np.array(gas.densities), np.array(gas.material_ids)
 
         try:
-            T = woma.A1_T_u_rho(u, rho, mat_id)
-            P = woma.A1_P_u_rho(u, rho, mat_id)
-            S = woma.A1_s_u_rho(u, rho, mat_id)
+            return {'T': woma.A1_T_u_rho(u, rho, mat_id),
+                    'P': woma.A1_P_u_rho(u, rho, mat_id),
+                    's': woma.A1_s_u_rho(u, rho, mat_id)}
         except ValueError:
-            gas.material_ids_mass_weighted = gas.material_ids * gas.masses
-            return
+            return {}
+
+    # SWIFT array of a particle field with the same cosmo factor as the loaded fields
+    def particle_array(self, values, units):
+        array = sw.objects.cosmo_array(values * units)
+        array.cosmo_factor = self.data.gas.internal_energies.cosmo_factor
+        return array
+
+    # registers a derived particle field, made from an array of values when first used (see derived_field_registry)
+    def register_field(self, name, values, units):
+        self.fields.register(name, lambda: self.particle_array(values, units))
+
+    # calculates the EOS for all particles, using fields from derived_fields if given
+    # the SWIFT arrays of the fields are only made when they are used
+    def calculate_EOS(self, fields=None):
 
-        gas.temperatures = sw.objects.cosmo_array(T * K)
-        gas.pressures = sw.objects.cosmo_array(P * Pa)
-        gas.entropy = sw.objects.cosmo_array(S * ((J / K) / kg))
+        fields = self.EOS_fields() if fields is None else fields
 
-        gas.temperatures.cosmo_factor = gas.internal_energies.cosmo_factor
-        gas.pressures.cosmo_factor = gas.internal_energies.cosmo_factor
-        gas.entropy.cosmo_factor = gas.internal_energies.cosmo_factor
+        gas = self.data.gas
+        gas.internal_energies.convert_to_mks()
+        gas.densities.convert_to_mks()
 
-        gas.temperatures_mass_weighted = gas.temperatures * gas.masses
-        gas.pressures_mass_weighted = gas.pressures * gas.masses
-        gas.entropy_mass_weighted = gas.entropy * gas.masses
-        gas.internal_energies_mass_weighted = gas.internal_energies * gas.masses
+        if 'T' not in fields:
+            return
 
-        gas.material_ids_mass_weighted = gas.material_ids * gas.masses
+        self.register_field('temperatures', fields['T'], K)
+        self.register_field('pressures', fields['P'], Pa)
+        self.register_field('entropy', fields['s'], (J / K) / kg)
 
         print('EOS calculated')
 
     # calculates the centre of mass in the snapshot
-    def get_center_of_mass(self):
+    def get_center_of_mass(self, weighting=None):
 
-        pos, densities = np.array(self.data.gas.coordinates), np.array(self.data.gas.densities)
-        mass_sum, mass_pos_sum = 0, 0
+        weighting = self.com_weighting if weighting is None else weighting
+        gas = self.data.gas
+        pos, masses, densities = np.array(gas.coordinates), np.array(gas.masses), np.array(gas.densities)
 
-        for i in range(pos.shape[0]):
-            mass_pos_sum += pos[i] * densities[i]
-            mass_sum += densities[i]
-        center_of_mass = np.array(mass_pos_sum / mass_sum) * Rearth
+        center_of_mass = particle_center_of_mass(pos, masses, densities, weighting=weighting) * Rearth
 
         print(f'Center of mass found at {center_of_mass}')
         return center_of_mass
 
-    # calculates the mass within a given radius (r needs to be in unyt form)
-    def mass_within_r(self, r):
+    # kd-tree of the particle positions relative to the centre of mass in Rearth (see particle_index), built when first
+    # used, its arrays are saved next to the snapshot and memory-mapped on later runs if cache_fields is True
+    @cached_property
+    def spatial_index(self):
+        build = lambda: particle_index_arrays(
+            np.array(self.data.gas.coordinates.to(Rearth)) - np.array(self.center_of_mass.to(Rearth)))
 
-        if type(r) is np.ndarray:
-            mass_total = np.zeros_like(r)
-            for i in range(len(r)):
-                mass_total[i] = np.sum(self.data.gas.masses[self.r < r[i]])
-            result = mass_total * kg
-        else:
-            self.data.gas.masses.convert_to_mks()
-            result = np.sum(self.data.gas.masses[self.r < r])
+        if not self.cache_fields:
+            return particle_index(build())
 
-        result.convert_to_units(M_earth)
-        return result
+        spec = dict(self.derived_fields_spec(), table='particle_index', leafsize=index_leafsize)
+        return particle_index(sidecar_arrays(self.filename, spec, build, 'particle index'))
 
-    # calculates the EOS for all particles    def calculate_EOS(self):
-        print('Applying EOS to particles...')
+    # indexes of the particles sorted by spherical radius r and cylindrical radius R_xy, built when first used
+    @cached_property
+    def r_mass_index(self):
+        return radial_mass_index(np.array(self.r.to(m)), np.array(self.data.gas.masses.to(kg)))
 
-        gas = self.data.gas
-        woma.load_eos_tables()
-        gas.internal_energies.convert_to_mks()
-        gas.densities.convert_to_mks()
+    @cached_property
+    def R_xy_mass_index(self):
+        return radial_mass_index(np.array(self.R_xy.to(m)), np.array(self.data.gas.masses.to(kg)))
 
-        u, rho, mat_id = np.array(gas.internal_energies), np.array(gas.densities), np.array(gas.material_ids)
+    def mass_index(self, cylindrical=False):
+        return self.R_xy_mass_index if cylindrical else self.r_mass_index
 
-        try:
-            T = woma.A1_T_u_rho(u, rho, mat_id)
-            P = woma.A1_P_u_rho(u, rho, mat_id)
-            S = woma.A1_s_u_rho(u, rho, mat_id)
-        except ValueError:
-            gas.material_ids_mass_weighted = gas.material_ids * gas.masses
-            return
+    # calculates the mass within a given radius, or within a cylindrical radius R_xy if cylindrical is True
+    # r can be a single radius or an array of radii (without units r is in Rearth)
+    def mass_within_r(self, r, cylindrical=False):
 
-        gas.temperatures = sw.objects.cosmo_array(T * K)
-        gas.pressures = sw.objects.cosmo_array(P * Pa)
-        gas.entropy = sw.objects.cosmo_array(S * ((J / K) / kg))
+        r = np.array(r.to(m)) if hasattr(r, 'units') else np.array((np.asarray(r) * Rearth).to(m))
+        result = self.mass_index(cylindrical).mass_within(r) * kg
 
-        gas.temperatures.cosmo_factor = gas.internal_energies.cosmo_factor
-        gas.pressures.cosmo_factor = gas.internal_energies.cosmo_factor
-        gas.entropy.cosmo_factor = gas.internal_energies.cosmo_factor
+        result.convert_to_units(M_earth)
+        return result
 
-        gas.temperatures_mass_weighted = gas.temperatures * gas.masses
-        gas.pressures_mass_weighted = gas.pressures * gas.masses
-        gas.entropy_mass_weighted = gas.entropy * gas.masses
-        gas.internal_energies_mass_weighted = gas.internal_energies * gas.masses
+    # smallest radius containing a given mass (e.g. for Hill and Roche radii of the enclosed mass), the inverse of
+    # mass_within_r (without units the mass is in kg)
+    def radius_enclosing_mass(self, mass, cylindrical=False):
 
-        gas.material_ids_mass_weighted = gas.material_ids * gas.masses
+        mass = np.array(mass.to(kg)) if hasattr(mass, 'units') else np.array(mass)
+        result = self.mass_index(cylindrical).radius_enclosing(mass) * m
 
-        print('EOS calculated')
+        result.convert_to_units(Rearth)
+        return result
 
-    # calculates the vertical, radial and angular velocities of the particles as well as the angular momentum
-    def calculate_velocities(self):
+    # specific angular momentum and the angular, radial and vertical velocities of the particles
+    def velocity_fields(self):
         gas = self.data.gas
 
         # changes the units to MKS for calculations as some vector operations remove the unit
@@ -216,25 +305,39 @@ class snapshot:
         gas.velocities.convert_to_mks()
         self.center_of_mass.convert_to_mks()
 
-        masses = gas.masses
         r, v = np.array(gas.coordinates - self.center_of_mass), np.array(gas.velocities)
 
         # h = np.cross(r, v)[:, 2] * ((m ** 2)/s)
         h = (r[:, 0] * v[:, 1] - r[:, 1] * v[:, 0]) * ((m ** 2)/s)
         omega = h / (self.R_xy ** 2)
 
-        v_r = np.sum(v * r, axis=1) / np.sqrt(np.sum(r * r, axis=1)) * (m/s)
-        v_z = v[:, 2] * np.sign(r[:, 2]) * (m/s)
+        v_r = np.sum(v * r, axis=1) / np.sqrt(np.sum(r * r, axis=1))
+        v_z = v[:, 2] * np.sign(r[:, 2])
+
+        self.center_of_mass.convert_to_units(Rearth)
+
+        return {'h': np.array(h.to((m ** 2)/s)), 'omega': np.array(omega.to(1/s)), 'v_r': v_r, 'v_z': v_z}
+
+    # calculates the vertical, radial and angular velocities of the particles as well as the angular momentum
+    # using fields from derived_fields if given
+    def calculate_velocities(self, fields=None):
+
+        fields = self.velocity_fields() if fields is None else fields
+
+        gas = self.data.gas
 
-        # puts the calculated velocities into SWIFT arrays
+        # the same units as when the velocities are calculated
+        gas.coordinates.convert_to_mks()
+        gas.velocities.convert_to_mks()
 
-        gas.angular_velocity = sw.objects.cosmo_array(omega)
-        gas.angular_velocity.cosmo_factor = gas.internal_energies.cosmo_factor
-        gas.angular_velocity_mass_weighted = gas.angular_velocity * gas.masses
+        masses = gas.masses
+        h = fields['h'] * ((m ** 2)/s)
 
-        gas.specific_angular_momentum = sw.objects.cosmo_array(h)
-        gas.specific_angular_momentum.cosmo_factor = gas.internal_energies.cosmo_factor
-        gas.specific_angular_momentum_mass_weighted = gas.specific_angular_momentum * gas.masses
+        # registers the calculated velocities as SWIFT arrays
+        self.register_field('angular_velocity', fields['omega'], 1/s)
+        self.register_field('specific_angular_momentum', fields['h'], (m ** 2)/s)
+        self.register_field('radial_velocity', fields['v_r'], m/s)
+        self.register_field('vertical_velocity', fields['v_z'], m/s)
 
         self.total_angular_momentum = np.sum(h * masses)
         self.total_angular_momentum.convert_to_mks()
@@ -245,16 +348,6 @@ class snapshot:
         self.total_specific_angular_momentum.convert_to_mks()
         print(f'Total specific angular momentum of particles {self.total_specific_angular_momentum:.4e}')
 
-        gas.radial_velocity = sw.objects.cosmo_array(v_r)
-        gas.radial_velocity.cosmo_factor = gas.internal_energies.cosmo_factor
-        gas.radial_velocity_mass_weighted = gas.radial_velocity * gas.masses
-
-        gas.vertical_velocity = sw.objects.cosmo_array(v_z)
-        gas.vertical_velocity.cosmo_factor = gas.internal_energies.cosmo_factor
-        gas.vertical_velocity_mass_weighted = gas.vertical_velocity * gas.masses
-
-        self.center_of_mass.convert_to_units(Rearth)
-
     # find the regions in the snapshot where the particle density is sufficient to analyse
     def particle_density_analysis(self):
 
@@ -302,7 +395,8 @@ class snapshot:
 
         # gets the particles in a valid region and takes the log of the cylindrical radius and angular velocity
         midplane_mask = (np.abs(self.z) < 0.5 * Rearth) & (self.R_xy < self.HD_limit_R)
-        log_R, log_omega = np.log10(self.R_xy[midplane_mask]), np.log10(self.data.gas.angular_velocity[midplane_mask])
+        omega = self.fields.get('angular_velocity')
+        log_R, log_omega = np.log10(self.R_xy[midplane_mask]), np.log10(omega[midplane_mask])
 
         # removes invalid values (NaN and inf)
         nan_inf_mask = np.isnan(log_R) | np.isnan(log_omega) | np.isinf(log_R) | np.isinf(log_omega)
@@ -338,13 +432,13 @@ class snapshot:
             rand = np.random.random(len(self.R_xy))
             #plot_mask = (((rand < 0.02) & (self.R_xy < 1)) | ((rand < 0.3) & (self.R_xy > 1))) & (np.abs(self.z) < 0.5 * Rearth)
             plot_mask = (np.abs(self.z) < 1 * Rearth) &\
-                        ~np.isnan(self.R_xy) & ~np.isnan(self.data.gas.angular_velocity) & \
-                        (np.log10(np.abs(self.data.gas.angular_velocity)) > -5.5) & \
+                        ~np.isnan(self.R_xy) & ~np.isnan(omega) & \
+                        (np.log10(np.abs(omega)) > -5.5) & \
                         (np.log10(np.abs(self.R_xy)) > 5.5)
 
             #plt.scatter(self.R_xy[plot_mask], self.data.gas.angular_velocity[plot_mask], s=0.2, c='blue', marker='o')
             x = np.log10(np.abs(self.R_xy[plot_mask]))
-            y = np.log10(np.abs(self.data.gas.angular_velocity[plot_mask]))
+            y = np.log10(np.abs(omega[plot_mask]))
             plt.hist2d(x, y, bins=100, cmap='Blues', norm=SymLogNorm(1))
 
             plt.plot(np.log10(x2), np.log10(best_fit_mks(x2)), linestyle='--', color='red', label='Best fit rotation curve')
@@ -410,17 +504,19 @@ class gas_slice:
 
         self.data['rho'].convert_to_units(kg / m ** 3)
 
+        # the mass weighted field is only kept in memory while it is sliced
         def get_slice(parameter):
-            mass_weighted_slice = slice_gas(
-                self.snapshot.data,
-                z_slice=z_slice,
-                resolution=self.resolution,
-                project=f'{parameter}_mass_weighted',
-                region=self.limits,
-                rotation_matrix=self.matrix,
-                rotation_center=self.snapshot.center_of_mass,
-                parallel=True
-            )
+            with self.snapshot.fields.using(f'{parameter}_mass_weighted'):
+                mass_weighted_slice = slice_gas(
+                    self.snapshot.data,
+                    z_slice=z_slice,
+                    resolution=self.resolution,
+                    project=f'{parameter}_mass_weighted',
+                    region=self.limits,
+                    rotation_matrix=self.matrix,
+                    rotation_center=self.snapshot.center_of_mass,
+                    parallel=True
+                )
 
             return mass_weighted_slice / self.data['rho']
 
@@ -0,0 +1,381 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+import EOS
+import EOS_cache
+import eostable
+from EOS_interpolation import grid_interpolator
+
+
+# writes SESAME files of a smooth synthetic EOS (in the units of the ANEOS tables) for a material_EOS to load
+# scale multiplies the pressure and the energy, to make the tables of different materials
+def write_synthetic_tables(directory, ND=60, NT=50, scale=1):
+    aneos_dir = os.path.join(os.path.dirname(os.path.abspath(EOS.__file__)), 'aneos-forsterite-2019-1.0.0')
+    for f in ['ANEOS.INPUT', 'ANEOS.OUTPUT']:
+        shutil.copy(os.path.join(aneos_dir, f), directory)
+
+    table = eostable.extEOStable()
+    table.ND, table.NT = ND, NT
+    table.rho = np.logspace(-12, 1.2, ND)  # g/cc
+    table.T = np.logspace(np.log10(200), 5, NT)  # K
+    rho, T = np.meshgrid(table.rho, table.T)
+
+    cv = 1e-3  # MJ/K/kg
+    table.U = scale * (cv * T + 5 * (rho / 3.22) ** 2)
+    table.P = scale * (0.5e-3 * rho * T + 100 * (rho / 3.22) ** 3)
+    table.S = cv * np.log(T) - 0.5e-3 * np.log(rho) - 0.003
+    table.A = table.U - T * table.S
+    table.cs, table.cv, table.KPA = 1e5 * np.sqrt(T / 300), np.full_like(T, cv), np.ones_like(T)
+    table.MATID, table.DATE, table.VERSION, table.FMN, table.FMW = 1, 190802, 0.1, 70, 140.691
+    table.R0REF, table.K0REF, table.T0REF = 3.22, 1.1e12, 298
+    table.writestdsesame(os.path.join(directory, 'NEW-SESAME-STD.TXT'))
+
+    with open(os.path.join(directory, 'NEW-SESAME-EXT.TXT'), 'w') as f:
+        f.write(' header\n' * 6)
+        values = np.concatenate([[ND, NT], table.rho, table.T, table.S.ravel(), table.cs.ravel(), table.cv.ravel(),
+                                 table.KPA.ravel()])
+        for k in range(0, len(values), 5):
+            f.write(''.join(f'{v:16.8e}' for v in values[k:k + 5]) + '\n')
+
+
+# reads the 301 table of a SESAME file one line at a time, as eostable did before readsesame301
+def read_sesame301_lines(fname, nvars):
+    with open(fname) as f:
+        lines = f.readlines()[6:]
+    ND, NT = float(lines[0][0:16]), float(lines[0][16:32])
+    neos = int(np.ceil((ND * NT * nvars + ND + NT + 2) / 5))
+    data = np.zeros((neos, 5))
+    for j in range(neos):
+        values = lines[j].split()
+        data[j, :len(values)] = values
+    return data.ravel()
+
+
+class TestSesame(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        write_synthetic_tables(self.directory, ND=37, NT=22)  # sizes that leave the last line of the tables short
+        self.files = [os.path.join(self.directory, f) for f in
+                      ['NEW-SESAME-STD.TXT', 'NEW-SESAME-EXT.TXT', 'ANEOS.INPUT', 'ANEOS.OUTPUT']]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_matches_line_by_line_parser(self):
+        for fname, nvars in [(self.files[0], 3), (self.files[1], 4)]:
+            np.testing.assert_array_equal(eostable.readsesame301(fname, nvars), read_sesame301_lines(fname, nvars))
+
+    def load(self):
+        table = eostable.extEOStable()
+        for k, v in EOS.forsterite_header.items():
+            setattr(table, k, v)
+        table.loadall(*self.files, cachedir=os.path.join(self.directory, 'cache'))
+        return table
+
+    def test_warm_cache_reload(self):
+        cold = self.load()
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'cache'))), 1)
+
+        warm = self.load()
+        self.assertIsInstance(warm.P, np.memmap)
+        self.assertEqual((warm.ND, warm.NT), (cold.ND, cold.NT))
+        for k in ['rho', 'T', 'P', 'U', 'S', 'cs', 'KPA']:
+            np.testing.assert_array_equal(getattr(warm, k), getattr(cold, k))
+        for k in ['T', 'Pl', 'Sv']:
+            np.testing.assert_array_equal(getattr(warm.vc, k), getattr(cold.vc, k))
+        self.assertEqual(warm.cp.P, cold.cp.P)
+
+    def test_changed_source_is_reparsed(self):
+        self.load()
+        os.utime(self.files[0], ns=(0, os.stat(self.files[0]).st_mtime_ns + 10 ** 9))
+        self.load()
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'cache'))), 2)
+
+
+class TestInterpolation(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.x = np.linspace(0, 10, 41)
+        self.y = np.concatenate((np.linspace(-3, 0, 20), np.logspace(-2, 1, 30)))
+        self.values = np.sin(self.x)[:, None] * np.cos(self.y)[None, :] + self.x[:, None] * self.y[None, :]
+
+    def test_matches_regular_grid_interpolator(self):
+        points = np.column_stack((self.rng.uniform(0, 10, 10000), self.rng.uniform(-3, 10, 10000)))
+        expected = RegularGridInterpolator((self.x, self.y), self.values)(points)
+        result = grid_interpolator(self.x, self.y, self.values)(points[:, 0], points[:, 1])
+        np.testing.assert_allclose(result, expected, rtol=1e-12, atol=1e-12)
+
+    def test_fill_value_outside_grid(self):
+        result = grid_interpolator(self.x, self.y, self.values, fill_value=np.nan)(np.array([-1, 5, 11]),
+                                                                                    np.array([0, 0, 0]))
+        self.assertTrue(np.isnan(result[0]) and np.isfinite(result[1]) and np.isnan(result[2]))
+
+    def test_float32_error_bound(self):
+        x, y = self.rng.uniform(0, 10, 10000), self.rng.uniform(-3, 10, 10000)
+        f64 = grid_interpolator(self.x, self.y, self.values)(x, y)
+        f32 = grid_interpolator(self.x, self.y, self.values, dtype=np.float32)(x, y)
+        self.assertLessEqual(np.max(np.abs(f32 - f64)), 8 * np.finfo(np.float32).eps * np.max(np.abs(self.values)))
+
+
+class TestAlphaV(unittest.TestCase):
+
+    def test_inverse(self):
+        rho, T = np.meshgrid(np.logspace(-6, 3, 50), np.logspace(2.5, 4.5, 50))
+        np.testing.assert_allclose(EOS.T_from_alpha_v(rho, EOS.alpha_v(rho, T)), T, rtol=1e-10)
+
+    def test_not_monotonic_at_high_density(self):
+        self.assertTrue(np.isnan(EOS.T_from_alpha_v(1e4, 1.0)))
+
+
+class TestMaterial(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        write_synthetic_tables(cls.directory)
+
+        # small derived tables so that they build quickly
+        cls.table_sizes = EOS.n_SP_table, EOS.n_uRho_table, EOS.n_alpha_table
+        EOS.n_SP_table, EOS.n_uRho_table, EOS.n_alpha_table = 60, 60, 60
+
+        cls.material = EOS.material_EOS(cls.directory, EOS.forsterite_header, 400,
+                                        table_dir=os.path.join(cls.directory, 'tables'))
+
+    @classmethod
+    def tearDownClass(cls):
+        EOS.n_SP_table, EOS.n_uRho_table, EOS.n_alpha_table = cls.table_sizes
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.rho, self.T = 10 ** rng.uniform(-6, 0.5, 5000), 10 ** rng.uniform(2.5, 4.5, 5000)  # SI units
+
+    def test_matches_regular_grid_interpolator(self):
+        NewEOS = self.material.NewEOS
+        points = np.column_stack((self.rho, self.T))
+        for name, table in [('P', NewEOS.P), ('S', NewEOS.S), ('u', NewEOS.U)]:
+            expected = RegularGridInterpolator((NewEOS.rho, NewEOS.T), table.T)(points)
+            result = getattr(self.material, f'{name}_EOS')(self.rho, self.T)
+            np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+
+    def test_invert_T_rho_X_round_trip(self):
+        NewEOS = self.material.NewEOS
+        u = self.material.u_EOS(self.rho, self.T)
+        np.testing.assert_allclose(self.material.invert_T_rho_X(NewEOS.U, self.rho, u), self.T, rtol=1e-10)
+
+        # values beyond the table are given the edge temperatures
+        u_edges = np.array([-1e10, 1e20])
+        np.testing.assert_array_equal(self.material.invert_T_rho_X(NewEOS.U, 1.0, u_edges), NewEOS.T[[0, -1]])
+
+
+    def test_legacy_S_P_table_import(self):
+        table = self.material.generate_table_S_P(n=EOS.n_SP_table, plot=False)
+        os.makedirs(self.material.table_dir, exist_ok=True)
+        for f, k in zip(self.material.legacy_S_P_files(EOS.n_SP_table), ['rho', 'T']):
+            np.save(f, table[k])
+
+        solver = EOS.SP_solver
+        EOS.SP_solver = 'nelder-mead'
+        try:
+            # woma is not needed, as the table is imported rather than rebuilt
+            material = EOS.material_EOS(self.directory, EOS.forsterite_header, 400, table_dir=self.material.table_dir)
+            imported = material.S_P_table
+            spec = EOS_cache.load_metadata(material.cache_dir, material.table_spec('S_P'))['spec']
+        finally:
+            EOS.SP_solver = solver
+            for f in self.material.legacy_S_P_files(EOS.n_SP_table):
+                os.remove(f)
+
+        self.assertEqual((spec['solver'], spec['n'], spec['S_range']), ('nelder-mead', EOS.n_SP_table, EOS.S_range))
+        for k in ['rho', 'T']:
+            np.testing.assert_array_equal(imported[k], table[k])
+        np.testing.assert_allclose(imported['error'], table['error'], rtol=1e-6, atol=1e-12)
+        np.testing.assert_allclose(imported['cell_error'], table['cell_error'], rtol=1e-6, atol=1e-12)
+
+
+    def test_phase_state_matches_separate_functions(self):
+        rng = np.random.default_rng(2)
+        S, P = rng.uniform(1000, 15000, 5000), 10 ** rng.uniform(-7, 12, 5000)
+        m = self.material
+
+        for D0 in [1e-3, 0]:
+            state = m.phase_state(self.rho, self.T, P, S, D0=D0)
+            np.testing.assert_array_equal(state['phase'], m.phase(S, P))
+            np.testing.assert_array_equal(state['vq'], m.vapor_quality(S, P))
+            np.testing.assert_array_equal(state['lvf'], m.liquid_volume_fraction(self.rho, P, S))
+            np.testing.assert_allclose(state['alpha'], m.alpha(self.rho, self.T, P, S, D0=D0), rtol=1e-14)
+            np.testing.assert_allclose(state['alpha_v'], m.alpha(self.rho, self.T, P, S, D0=0), rtol=1e-14)
+
+        self.assertTrue(np.all(np.isin([0, 1, 2, 3, 4], state['phase'])))
+
+
+    def test_dome_lever_rule(self):
+        m = self.material
+        P, q = np.geomspace(1e2, 1e7, 50), np.linspace(0, 1, 50)
+        Sl, Sv = m.S_vapor_curve_l(P), m.S_vapor_curve_v(P)
+        S = Sl + q * (Sv - Sl)
+
+        rho = 1 / ((1 - q) / m.rho_vapor_curve_l(P) + q / m.rho_vapor_curve_v(P))
+        T = (1 - q) * m.T_vapor_curve_l(P) + q * m.T_vapor_curve_v(P)
+        np.testing.assert_allclose(m.rho_EOS(S, P), rho, rtol=1e-12)
+        np.testing.assert_allclose(m.T1_EOS(S, P), T, rtol=1e-12)
+
+    def test_dome_edge_scalar_and_array(self):
+        m = self.material
+        P = np.geomspace(1e2, 1e7, 7)
+        S = float(m.S_vapor_curve_l(P[3])) - 10  # in the table cell cut by the liquid edge of the dome at P[3]
+
+        for f in [m.rho_EOS, m.T1_EOS]:
+            np.testing.assert_array_equal(f(S, P), f(np.full_like(P, S), P))
+            np.testing.assert_array_equal(f(np.full_like(P, S), P[3]), f(np.full_like(P, S), np.full_like(P, P[3])))
+            self.assertEqual(f(S, P[3]), f(S, P)[3])
+
+
+    def test_table_error(self):
+        m, rng = self.material, np.random.default_rng(3)
+        cell = lambda points, x: np.clip(np.searchsorted(points, x, side='right') - 1, 0, len(points) - 2)
+
+        S_points, logP_points = m.S_P_grid(EOS.n_SP_table)
+        S, P = rng.uniform(*EOS.S_range, 2000), 10 ** rng.uniform(*EOS.log_P_range, 2000)
+        with np.errstate(invalid='ignore'):
+            dome = (S >= m.S_vapor_curve_l(P)) & (S <= m.S_vapor_curve_v(P))
+        expected = np.asarray(m.S_P_table['cell_error'])[cell(logP_points, np.log10(P)), cell(S_points, S)]
+        np.testing.assert_array_equal(m.table_error(S, P), np.where(dome, 0, expected))
+        self.assertTrue(np.any(dome) and np.any(expected[~dome] > 0))
+
+        u_points, log_rho_points = m.u_rho_grid(EOS.n_uRho_table)
+        u, rho = rng.uniform(0, 10 ** EOS.log_u_range[1], 2000), 10 ** rng.uniform(*EOS.log_rho_range, 2000)
+        expected = np.asarray(m.u_rho_table['cell_error'])[cell(u_points, u), cell(log_rho_points, np.log10(rho))]
+        np.testing.assert_array_equal(m.table_error(u, rho, table='u_rho'), expected)
+
+        # points outside the tables
+        self.assertTrue(np.all(np.isinf(m.table_error(np.array([0, 3000, 3e4]), np.array([1e5, 1e15, 1e5])))))
+        self.assertTrue(np.all(np.isinf(m.table_error(np.array([-1, 1e9]), np.array([1, 1]), table='u_rho'))))
+
+
+    def test_by_material(self):
+        directory = os.path.join(self.directory, 'second')
+        os.makedirs(directory)
+        write_synthetic_tables(directory, scale=2)
+        second = EOS.material_EOS(directory, dict(EOS.forsterite_header, MODELNAME='second'), 401,
+                                  table_dir=os.path.join(directory, 'tables'))
+        missing = EOS.material_EOS(os.path.join(self.directory, 'missing'), EOS.iron_header, 402)
+
+        with mock.patch.dict(EOS.materials, {400: self.material, 401: second, 402: missing}, clear=True):
+            # mass weighted slices mix the ids, which are rounded, and NaN ids use default_matid
+            matid = np.random.default_rng(4).choice([400, 401, 400.2, 400.8, np.nan], self.rho.size)
+            is_second = np.isclose(matid, 401) | np.isclose(matid, 400.8)
+
+            P = EOS.by_material('P_EOS', matid, self.rho, self.T)
+            np.testing.assert_array_equal(P, np.where(is_second, second.P_EOS(self.rho, self.T),
+                                                      self.material.P_EOS(self.rho, self.T)))
+            np.testing.assert_allclose(P[is_second], 2 * self.material.P_EOS(self.rho, self.T)[is_second], rtol=1e-6)
+
+            state = EOS.by_material('state_from_rhoT', matid, self.rho, self.T, fields=['P', 'u'])
+            np.testing.assert_array_equal(state['P'], P)
+
+            # a single id broadcasts against the arrays
+            np.testing.assert_array_equal(EOS.by_material('P_EOS', 401, self.rho, self.T),
+                                          second.P_EOS(self.rho, self.T))
+
+            with self.assertRaises(ValueError):
+                EOS.by_material('P_EOS', np.array([400, 403]), self.rho[:2], self.T[:2])
+            with self.assertRaises(FileNotFoundError):
+                EOS.by_material('P_EOS', np.array([400, 402]), self.rho[:2], self.T[:2])
+
+
+    def test_solve_round_trip(self):
+        state = self.material.state_from_rhoT(self.rho, self.T, fields=['P', 'S', 'u'])
+        state.update(rho=self.rho, T=self.T)
+
+        for X, Y in [('S', 'P'), ('u', 'rho'), ('P', 'T')]:
+            result = self.material.solve({X: state[X], Y: state[Y]}, fields=('rho', 'T'))
+            self.assertGreater(np.mean(result['converged']), 0.99)
+
+            converged = result['converged']
+            np.testing.assert_allclose(result['rho'][converged], self.rho[converged], rtol=1e-6)
+            np.testing.assert_allclose(result['T'][converged], self.T[converged], rtol=1e-6)
+
+    def test_solve_non_finite(self):
+        P, S = self.material.P_EOS(self.rho[:4], self.T[:4]), self.material.S_EOS(self.rho[:4], self.T[:4])
+        P[1], S[2], P[3] = np.nan, np.inf, -np.inf
+
+        result = self.material.solve({'P': P, 'S': S}, fields=('rho', 'T', 'P'))
+        np.testing.assert_array_equal(result['converged'], [True, False, False, False])
+        np.testing.assert_array_equal(result['error'][1:], np.inf)
+        self.assertTrue(np.all(np.isnan(result['rho'][1:])) and np.all(np.isnan(result['T'][1:])))
+        np.testing.assert_allclose([result['rho'][0], result['T'][0]], [self.rho[0], self.T[0]], rtol=1e-6)
+
+        result = self.material.solve({'P': np.full(3, np.nan), 'S': S[:3]})
+        self.assertFalse(np.any(result['converged']))
+
+
+    def test_memo(self):
+        self.material.enable_memo()
+        try:
+            first = self.material.P_EOS(self.rho, self.T)
+            second = self.material.P_EOS(self.rho, self.T)
+            np.testing.assert_array_equal(first, second)
+            self.assertEqual(self.material.memo.stats()['hits'], 1)
+
+            # the cached result can not be changed by the caller
+            second[:] = 0
+            np.testing.assert_array_equal(self.material.P_EOS(self.rho, self.T), first)
+        finally:
+            self.material.disable_memo()
+
+    def test_memo_different_fields(self):
+        self.material.enable_memo()
+        try:
+            # each fields list is freed after the call, so the next list can get the same id
+            P = self.material.state_from_rhoT(self.rho, self.T, fields=['P'])
+            u = self.material.state_from_rhoT(self.rho, self.T, fields=['u'])
+            self.assertEqual(list(u.keys()), ['u'])
+            np.testing.assert_array_equal(u['u'], self.material.u_EOS(self.rho, self.T))
+            self.assertEqual(self.material.memo.stats()['functions']['state_from_rhoT'], {'hits': 0, 'misses': 2})
+
+            # a new list with the same fields is a hit
+            np.testing.assert_array_equal(self.material.state_from_rhoT(self.rho, self.T, fields=['P'])['P'], P['P'])
+            self.assertEqual(self.material.memo.stats()['functions']['state_from_rhoT'], {'hits': 1, 'misses': 2})
+        finally:
+            self.material.disable_memo()
+
+
+    def test_chunked_equals_serial(self):
+        S, P = self.material.S_EOS(self.rho, self.T), self.material.P_EOS(self.rho, self.T)
+        rho, T = self.rho.reshape(50, 100), self.T[:100]  # broadcast against each other
+        calls = {
+            'P_EOS': lambda: self.material.P_EOS(self.rho, self.T),
+            'P_EOS 2D': lambda: self.material.P_EOS(rho, T),
+            'P_EOS out': lambda: self.material.P_EOS(self.rho, self.T, out=np.empty_like(self.rho)),
+            'rho_EOS': lambda: self.material.rho_EOS(S, P),
+            'rho_EOS scalar S': lambda: self.material.rho_EOS(4000.0, P),
+            'state_from_rhoT': lambda: self.material.state_from_rhoT(self.rho, self.T),
+            'state_from_SP': lambda: self.material.state_from_SP(S, P),
+        }
+        serial = {k: f() for k, f in calls.items()}
+
+        settings = EOS.n_threads, EOS.chunk_size
+        EOS.n_threads, EOS.chunk_size = 4, 700
+        try:
+            for k, f in calls.items():
+                result, expected = f(), serial[k]
+                if isinstance(expected, dict):
+                    for field in expected:
+                        np.testing.assert_array_equal(result[field], expected[field])
+                else:
+                    np.testing.assert_array_equal(result, expected)
+        finally:
+            EOS.n_threads, EOS.chunk_size = settings
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+
+import EOS_cache
+import particle_analysis as pa
+
+
+class TestCenterOfMass(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.pos = rng.normal(size=(20000, 3)) + [1, 2, 3]
+        self.masses, self.densities = rng.uniform(1, 2, 20000), rng.uniform(1, 5, 20000)
+
+    def test_weightings(self):
+        chunk_size = pa.chunk_size
+        pa.chunk_size = 3000
+        try:
+            np.testing.assert_allclose(pa.particle_center_of_mass(self.pos, self.masses, weighting='mass'),
+                                       self.masses @ self.pos / np.sum(self.masses), rtol=1e-12)
+            np.testing.assert_allclose(pa.particle_center_of_mass(self.pos, self.masses, self.densities, 'density'),
+                                       self.densities @ self.pos / np.sum(self.densities), rtol=1e-12)
+        finally:
+            pa.chunk_size = chunk_size
+
+    def test_shrinking_sphere_ignores_ejecta(self):
+        pos = np.concatenate((self.pos, np.random.default_rng(2).normal(size=(2000, 3)) + [50, 0, 0]))
+        masses = np.ones(len(pos))
+        center = pa.particle_center_of_mass(pos, masses, weighting='shrinking_sphere')
+        np.testing.assert_allclose(center, [1, 2, 3], atol=0.2)
+
+    def test_unknown_weighting(self):
+        with self.assertRaises(ValueError):
+            pa.particle_center_of_mass(self.pos, self.masses, weighting='volume')
+
+
+class TestRadialMassIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.radii = rng.uniform(0, 10, 5000)
+        self.radii[:100] = self.radii[100:200]  # repeated radii
+        self.masses = rng.uniform(1, 2, 5000)
+        self.index = pa.radial_mass_index(self.radii, self.masses)
+
+    def test_mass_within(self):
+        r = np.concatenate(([-1, 0, 11], self.radii[:50], np.linspace(0, 10, 50)))
+        expected = [np.sum(self.masses[self.radii < x]) for x in r]
+        np.testing.assert_allclose(self.index.mass_within(r), expected, rtol=1e-12)
+
+    def test_radius_enclosing(self):
+        mass = np.linspace(0, np.sum(self.masses), 50)
+        radius = self.index.radius_enclosing(mass)
+        self.assertTrue(np.all([np.sum(self.masses[self.radii <= r]) >= m * (1 - 1e-12) for r, m in zip(radius, mass)]))
+        self.assertTrue(np.all([np.sum(self.masses[self.radii < r]) < m or m == 0 for r, m in zip(radius, mass)]))
+        self.assertEqual(self.index.radius_enclosing(2 * np.sum(self.masses)), np.inf)
+
+
+
+class TestSidecar(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'snapshot_0001.hdf5')
+        with open(self.filename, 'wb') as f:
+            f.write(np.random.default_rng(5).bytes(3 * pa.signature_bytes))
+        self.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self):
+        self.builds += 1
+        return {'T': np.arange(10.0), 'P': np.ones(10)}
+
+    def load(self, version=1):
+        spec = {'table': 'particle_fields', 'signature': pa.file_signature(self.filename), 'version': version}
+        return pa.sidecar_arrays(self.filename, spec, self.build, 'test fields')
+
+    def test_hit_and_miss(self):
+        fields = self.load()
+        self.assertEqual(self.builds, 1)
+        self.assertTrue(os.path.isdir(os.path.join(self.directory, 'snapshot_0001_derived')))
+
+        cached = self.load()
+        self.assertEqual(self.builds, 1)
+        self.assertIsInstance(cached['T'], np.memmap)
+        for k in fields:
+            np.testing.assert_array_equal(cached[k], fields[k])
+
+        # a new version of the derived fields is a miss
+        self.load(version=2)
+        self.assertEqual(self.builds, 2)
+
+    def test_independent_of_EOS_cache_version(self):
+        self.load()
+        with mock.patch.object(EOS_cache, 'cache_version', EOS_cache.cache_version + 1):
+            self.load()
+        self.assertEqual(self.builds, 1)
+
+    def test_changed_file_is_a_miss(self):
+        self.load()
+        with open(self.filename, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'x' if f.read(1) != b'x' else b'y')
+        self.load()
+        self.assertEqual(self.builds, 2)
+
+    def test_unwritable_sidecar(self):
+        with mock.patch.object(EOS_cache, 'save_table', side_effect=PermissionError('read-only')):
+            np.testing.assert_array_equal(self.load()['T'], np.arange(10.0))
+            self.load()
+        self.assertEqual(self.builds, 2)
+
+
+
+class TestDerivedFieldRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.gas = SimpleNamespace(masses=np.array([1.0, 2.0, 3.0]), densities=np.array([4.0, 5.0, 6.0]))
+        self.fields = pa.derived_field_registry(self.gas)
+        self.calls = 0
+        self.fields.register('temperatures', self.temperatures)
+
+    def temperatures(self):
+        self.calls += 1
+        return np.array([10.0, 20.0, 30.0])
+
+    def test_calculated_once_when_first_used(self):
+        self.assertFalse(hasattr(self.gas, 'temperatures'))
+        np.testing.assert_array_equal(self.fields.get('temperatures'), [10, 20, 30])
+        self.fields.get('temperatures')
+        self.assertEqual(self.calls, 1)
+        np.testing.assert_array_equal(self.gas.temperatures, [10, 20, 30])
+
+    def test_mass_weighted(self):
+        np.testing.assert_array_equal(self.fields.get('temperatures_mass_weighted'), [10, 40, 90])
+        np.testing.assert_array_equal(self.fields.get('densities_mass_weighted'), [4, 10, 18])
+        with self.assertRaises(AttributeError):
+            self.fields.get('pressures_mass_weighted')
+
+    def test_using_releases_only_the_fields_it_calculated(self):
+        self.fields.get('temperatures')
+        with self.fields.using('temperatures', 'temperatures_mass_weighted', 'densities_mass_weighted'):
+            self.assertTrue(hasattr(self.gas, 'temperatures_mass_weighted'))
+            self.assertTrue(hasattr(self.gas, 'densities_mass_weighted'))
+
+        self.assertTrue(hasattr(self.gas, 'temperatures') and hasattr(self.gas, 'densities'))
+        self.assertFalse(hasattr(self.gas, 'temperatures_mass_weighted'))
+        self.assertFalse(hasattr(self.gas, 'densities_mass_weighted'))
+        self.assertEqual(self.calls, 1)
+
+    def test_using_releases_after_an_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.fields.using('temperatures'):
+                raise RuntimeError
+        self.assertFalse(hasattr(self.gas, 'temperatures'))
+
+    def test_release_and_recalculate(self):
+        self.fields.require('temperatures', 'temperatures_mass_weighted')
+        self.fields.release('temperatures', 'densities')
+        self.assertFalse(hasattr(self.gas, 'temperatures'))
+        self.assertTrue(hasattr(self.gas, 'densities'))  # loaded fields are not released
+
+        self.fields.get('temperatures')
+        self.assertEqual(self.calls, 2)
+
+    def test_register_replaces_field(self):
+        self.fields.require('temperatures', 'temperatures_mass_weighted')
+        self.fields.register('temperatures', lambda: np.array([1.0, 1.0, 1.0]))
+        self.assertFalse(hasattr(self.gas, 'temperatures_mass_weighted'))
+        np.testing.assert_array_equal(self.fields.get('temperatures_mass_weighted'), [1, 2, 3])
+
+
+
+class TestParticleIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.pos = np.random.default_rng(3).normal(size=(50000, 3))
+        self.index = pa.particle_index(pa.particle_index_arrays(self.pos, leafsize=16))
+
+    def check(self, result, mask):
+        np.testing.assert_array_equal(result, np.flatnonzero(mask))
+
+    def test_ball_and_shell(self):
+        r = np.sqrt(np.sum((self.pos - [0.5, 0, -0.5]) ** 2, axis=1))
+        self.check(self.index.ball(1, center=[0.5, 0, -0.5]), r <= 1)
+        self.check(self.index.shell(0.8, 1.2, center=[0.5, 0, -0.5]), (r >= 0.8) & (r <= 1.2))
+
+    def test_box(self):
+        lower, upper = [-0.5, -1, -np.inf], [1, 0.25, 0.5]
+        self.check(self.index.box(lower, upper), np.all((self.pos >= lower) & (self.pos <= upper), axis=1))
+
+    def test_slab(self):
+        self.check(self.index.slab(-0.1, 0.3), (self.pos[:, 2] >= -0.1) & (self.pos[:, 2] <= 0.3))
+
+    def test_annulus(self):
+        R = np.sqrt(np.sum(self.pos[:, :2] ** 2, axis=1))
+        self.check(self.index.annulus(0.5, 1.5, z_max=0.2), (R >= 0.5) & (R <= 1.5) & (np.abs(self.pos[:, 2]) <= 0.2))
+        self.check(self.index.annulus(1, 2), (R >= 1) & (R <= 2))
+
+    def test_empty_and_whole_regions(self):
+        self.check(self.index.ball(0.5, center=[100, 0, 0]), np.zeros(len(self.pos), dtype=bool))
+        self.check(self.index.box([-np.inf] * 3, [np.inf] * 3), np.ones(len(self.pos), dtype=bool))
+
+    def test_nearest(self):
+        distances, j = self.index.nearest(self.pos[:10] + 1e-9)
+        np.testing.assert_array_equal(j, np.arange(10))
+
+    def test_saved_arrays(self):
+        directory = tempfile.mkdtemp()
+        try:
+            spec = {'table': 'particle_index', 'leafsize': 16}
+            EOS_cache.save_table(directory, spec, self.index.arrays, versioned=False)
+            index = pa.particle_index(EOS_cache.load_table(directory, spec, versioned=False))
+            np.testing.assert_array_equal(index.ball(1), self.index.ball(1))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()